@@ -0,0 +1,90 @@
+"""
+Exact-match response cache for Gemini text calls.
+
+Keyed by sha256(model + "\\0" + full prompt). Two tiers:
+  - in-process LRU (GEMINI_CACHE_SIZE entries, default 2048)
+  - Redis, shared across workers, with a TTL (only when REDIS_URL is set
+    and the `redis` package is installed)
+Disabled unless GEMINI_CACHE=1.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+CACHE_ENABLED = os.getenv("GEMINI_CACHE", "0") == "1"
+CACHE_TTL_S = int(os.getenv("GEMINI_CACHE_TTL", str(24 * 3600)))
+CACHE_SIZE = int(os.getenv("GEMINI_CACHE_SIZE", "2048"))
+
+_local: "OrderedDict[str, str]" = OrderedDict()
+_local_lock = threading.Lock()
+
+_redis = None
+_redis_checked = False
+_redis_lock = threading.Lock()
+
+
+def cache_key(model: str, prompt: str) -> str:
+    return hashlib.sha256((model + "\0" + prompt).encode("utf-8")).hexdigest()
+
+
+def _redis_client():
+    """Lazily connect to Redis; returns None when not configured or unavailable."""
+    global _redis, _redis_checked
+    if _redis_checked:
+        return _redis
+    with _redis_lock:
+        if not _redis_checked:
+            url = os.getenv("REDIS_URL")
+            if url:
+                try:
+                    import redis
+                    _redis = redis.Redis.from_url(url, socket_timeout=0.25)
+                    _redis.ping()
+                except Exception as e:
+                    print(f"[llm_cache] redis tier disabled: {e}")
+                    _redis = None
+            _redis_checked = True
+    return _redis
+
+
+def get(key: str) -> Optional[str]:
+    with _local_lock:
+        hit = _local.get(key)
+        if hit is not None:
+            _local.move_to_end(key)
+            return hit
+    r = _redis_client()
+    if r is None:
+        return None
+    try:
+        raw = r.get(f"gemini:{key}")
+    except Exception:
+        return None
+    if raw is None:
+        return None
+    text = raw.decode("utf-8")
+    _put_local(key, text)
+    return text
+
+
+def _put_local(key: str, text: str) -> None:
+    with _local_lock:
+        _local[key] = text
+        _local.move_to_end(key)
+        while len(_local) > CACHE_SIZE:
+            _local.popitem(last=False)
+
+
+def put(key: str, text: str) -> None:
+    # empty replies are usually transient failures; don't pin them
+    if not text:
+        return
+    _put_local(key, text)
+    r = _redis_client()
+    if r is not None:
+        try:
+            r.set(f"gemini:{key}", text.encode("utf-8"), ex=CACHE_TTL_S)
+        except Exception:
+            pass
@@ -0,0 +1,93 @@
+"""
+Semantic (paraphrase-tolerant) cache for small LLM results.
+
+Entries are MiniLM embeddings of the key text; a lookup is a flat inner-product
+search (cosine, vectors are normalized) over all entries with the same `tag`.
+Hits need similarity >= GEMINI_SEMANTIC_THRESHOLD (default 0.92).
+Persisted as <name>.npy (vectors) + <name>.json (tags/values) under
+GEMINI_SEMANTIC_CACHE_DIR. Disabled unless GEMINI_SEMANTIC_CACHE=1.
+"""
+import copy
+import json
+import os
+import threading
+from typing import Any, List, Optional
+
+import numpy as np
+
+from retrieval.hybrid_search import get_embedder
+
+SEMANTIC_CACHE_ENABLED = os.getenv("GEMINI_SEMANTIC_CACHE", "0") == "1"
+SEMANTIC_THRESHOLD = float(os.getenv("GEMINI_SEMANTIC_THRESHOLD", "0.92"))
+SEMANTIC_CACHE_DIR = os.getenv("GEMINI_SEMANTIC_CACHE_DIR", "data/semantic_cache")
+
+class SemanticCache:
+    def __init__(self, name: str, threshold: float = SEMANTIC_THRESHOLD, cache_dir: str = SEMANTIC_CACHE_DIR):
+        self.name = name
+        self.threshold = threshold
+        self._vec_path = os.path.join(cache_dir, f"{name}.npy")
+        self._meta_path = os.path.join(cache_dir, f"{name}.json")
+        self._lock = threading.Lock()
+        self._vecs: Optional[np.ndarray] = None   # (N, D) float32, rows L2-normalized
+        self._tags: List[str] = []
+        self._values: List[Any] = []
+        self._load()
+
+    def _load(self):
+        try:
+            vecs = np.load(self._vec_path)
+            with open(self._meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if len(meta["tags"]) == len(meta["values"]) == vecs.shape[0]:
+                self._vecs = vecs.astype(np.float32, copy=False)
+                self._tags, self._values = meta["tags"], meta["values"]
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"[semantic_cache] {self.name}: ignoring unreadable cache: {e}")
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self._vec_path), exist_ok=True)
+        tmp_vec, tmp_meta = self._vec_path + ".tmp.npy", self._meta_path + ".tmp"
+        np.save(tmp_vec, self._vecs)
+        with open(tmp_meta, "w", encoding="utf-8") as f:
+            json.dump({"tags": self._tags, "values": self._values}, f, ensure_ascii=False)
+        os.replace(tmp_vec, self._vec_path)
+        os.replace(tmp_meta, self._meta_path)
+
+    @staticmethod
+    def _embed(text: str) -> np.ndarray:
+        v = get_embedder().encode([text], normalize_embeddings=True)[0]
+        return np.asarray(v, dtype=np.float32)
+
+    def _nearest(self, vec: np.ndarray, tag: str) -> Optional[int]:
+        if self._vecs is None or not len(self._tags):
+            return None
+        sims = self._vecs @ vec
+        sims[[t != tag for t in self._tags]] = -1.0
+        best = int(np.argmax(sims))
+        return best if sims[best] >= self.threshold else None
+
+    def get(self, text: str, tag: str = "") -> Optional[Any]:
+        """Return a copy of the value stored for the closest paraphrase of `text`, or None."""
+        vec = self._embed(text)
+        with self._lock:
+            idx = self._nearest(vec, tag)
+            return copy.deepcopy(self._values[idx]) if idx is not None else None
+
+    def put(self, text: str, value: Any, tag: str = "") -> None:
+        """Store `value`; an existing near-duplicate entry is overwritten instead of added."""
+        vec = self._embed(text)
+        with self._lock:
+            idx = self._nearest(vec, tag)
+            if idx is not None:
+                self._values[idx] = copy.deepcopy(value)
+            else:
+                row = vec.reshape(1, -1)
+                self._vecs = row if self._vecs is None else np.vstack([self._vecs, row])
+                self._tags.append(tag)
+                self._values.append(copy.deepcopy(value))
+            try:
+                self._save()
+            except Exception as e:
+                print(f"[semantic_cache] {self.name}: save failed: {e}")
@@ -1,59 +1,97 @@
-import os, re, json
-from typing import Any, Dict, List, Optional
+import asyncio, os, re, threading
+from typing import Any, Dict, List, Optional, Tuple
 from google import genai
 from google.genai import types
 import itertools
+import numpy as np
+import orjson
+
+from . import _llm_cache
+from ._semantic_cache import SEMANTIC_CACHE_ENABLED, SemanticCache
 
 DEFAULT_TEXT_MODEL = os.getenv("GEMINI_TEXT_MODEL", "gemini-2.0-flash")
 
-def _client():
-    api_key = os.getenv("GEMINI_API_KEY")
-    if not api_key:
-        raise RuntimeError("GEMINI_API_KEY not set")
-    return genai.Client(api_key=api_key)
+# paraphrase caches: chat → parsed TaskSpec dict, topic → list of image prompt lines
+_NORMALIZE_SEMCACHE = SemanticCache("normalize") if SEMANTIC_CACHE_ENABLED else None
+_IMAGE_SEMCACHE = SemanticCache("image_prompt") if SEMANTIC_CACHE_ENABLED else None
+
+_CLIENT = None
+_CLIENT_LOCK = threading.Lock()
+
+def get_client():
+    """Process-wide client, so every call shares one connection pool (sync and .aio)."""
+    global _CLIENT
+    if _CLIENT is None:
+        with _CLIENT_LOCK:
+            if _CLIENT is None:
+                api_key = os.getenv("GEMINI_API_KEY")
+                if not api_key:
+                    raise RuntimeError("GEMINI_API_KEY not set")
+                _CLIENT = genai.Client(api_key=api_key)
+    return _CLIENT
+
+_JSON_FENCE = re.compile(r"```(?:json)?\s*([\s\S]*?)\s*```", re.IGNORECASE)
+
+_MAX_JSON_SCAN = 1 << 20   # chars; larger replies are not brace-scanned at all
+
+def _balanced_prefix(s: str) -> Optional[str]:
+    """
+    Return s up to the '}' that closes its leading '{', or None if it never closes.
+    Braces inside JSON strings are ignored. Single vectorized pass over the UTF-8 bytes:
+      - a '"' is real unless preceded by an odd run of backslashes
+      - a byte is inside a string when an odd number of real quotes precede/include it
+      - depth = cumsum(+1 per '{', -1 per '}') counting only bytes outside strings
+    """
+    if len(s) > _MAX_JSON_SCAN:
+        return None
+    buf = np.frombuffer(s.encode("utf-8"), dtype=np.uint8)
+    if not buf.size:
+        return None
+    pos = np.arange(buf.size)
+    last_plain = np.maximum.accumulate(np.where(buf == 0x5C, -1, pos))   # last non-backslash at/before i
+    bs_run = np.zeros(buf.size, dtype=np.int64)
+    bs_run[1:] = pos[:-1] - last_plain[:-1]                               # backslashes right before i
+    quote = (buf == 0x22) & (bs_run % 2 == 0)
+    outside = np.cumsum(quote) % 2 == 0
+    opens = (buf == 0x7B) & outside
+    closes = (buf == 0x7D) & outside
+    depth = np.cumsum(opens.astype(np.int8) - closes)
+    ends = np.flatnonzero(closes & (depth == 0))
+    if not ends.size:
+        return None
+    # braces are ASCII, so cutting right after one never splits a UTF-8 sequence
+    return buf[:ends[0] + 1].tobytes().decode("utf-8")
 
 def _extract_json(text: str) -> Any:
-    # 1) direct
-    try:
-        return json.loads(text)
-    except Exception:
-        pass
-    # 2) fenced ```json ... ```
-    fence = re.search(r"```(?:json)?\s*([\s\S]*?)\s*```", text, flags=re.IGNORECASE)
+    text = text or ""
+    # 1) direct: only worth trying when the reply already starts like JSON
+    ts = text.lstrip()
+    if ts.startswith(("{", "[")):
+        try:
+            return orjson.loads(ts)
+        except Exception:
+            pass
+    # 2) fenced ```json ... ``` (skip the regex entirely when there is no fence)
+    fence = _JSON_FENCE.search(text) if "```" in text else None
     if fence:
         blk = fence.group(1).strip()
         try:
-            return json.loads(blk)
+            return orjson.loads(blk)
         except Exception:
             last = blk.rfind("}")
             if last != -1:
                 try:
-                    return json.loads(blk[:last+1])
+                    return orjson.loads(blk[:last+1])
                 except Exception:
                     pass
-    # 3) brace-balance from first '{'
+    # 3) brace-balance from first '{' (string-aware; gives up on > _MAX_JSON_SCAN)
     if "{" in text and "}" in text:
-        s = text[text.find("{"):]
-        depth = 0
-        end_idx = None
-        for i, ch in enumerate(s):
-            if ch == "{": depth += 1
-            elif ch == "}":
-                depth -= 1
-                if depth == 0:
-                    end_idx = i
-                    break
-        if end_idx is not None:
-            candidate = s[:end_idx+1]
+        candidate = _balanced_prefix(text[text.find("{"):])
+        if candidate is not None:
             try:
-                return json.loads(candidate)
+                return orjson.loads(candidate)
             except Exception:
-                last = candidate.rfind("}")
-                if last != -1:
-                    try:
-                        return json.loads(candidate[:last+1])
-                    except Exception:
-                        pass
+                pass
     return {"raw": text}
 
 # ---------- Sanitizers ----------
@@ -99,6 +137,9 @@ def _sanitize_segment(seg: Dict[str, Any]) -> Dict[str, Any]:
     # If mermaid leaked into text, pull it out
     text_wo_mermaid, mermaid_in_text = _pop_mermaid_from_text(raw_text)
 
+    # section heading: the model sometimes numbers it or nests it
+    s["section"] = _coerce_str(s.get("section"))
+
     # text_format
     if s.get("text_format") not in ("md", "plain"):
         s["text_format"] = "md"
@@ -195,32 +236,142 @@ def _pop_mermaid_from_text(md: str) -> tuple[str, Optional[str]]:
     return md, None
 
 
+# ---------- Gemini calls ----------
+
+def _response_text(res) -> str:
+    return res.candidates[0].content.parts[0].text if res.candidates else ""
+
+_TIER_SUPPORTED = "service_tier" in getattr(types.GenerateContentConfig, "model_fields", {})
+
+def _tier_kwargs(service_tier: Optional[str]) -> Dict[str, Any]:
+    # older google-genai builds have no service_tier field; send the request on the default tier
+    return {"service_tier": service_tier} if service_tier and _TIER_SUPPORTED else {}
+
+def _text_config(service_tier: Optional[str] = None) -> types.GenerateContentConfig:
+    return types.GenerateContentConfig(response_modalities=["TEXT"], **_tier_kwargs(service_tier))
+
+def _chunk_text(chunk) -> str:
+    # stream chunks can arrive without candidates/parts (e.g. the final usage-only chunk)
+    try:
+        return _response_text(chunk) or ""
+    except (AttributeError, IndexError, TypeError):
+        return ""
+
+def _json_complete(buf: str) -> bool:
+    """True once buf holds a leading JSON object that is closed and parses."""
+    start = buf.find("{")
+    if start == -1:
+        return False
+    candidate = _balanced_prefix(buf[start:])
+    if candidate is None:
+        return False
+    try:
+        orjson.loads(candidate)
+        return True
+    except Exception:
+        return False
+
+def _stream_until_json(client, model_name: str, contents, config) -> str:
+    """Stream the reply and hang up as soon as the JSON object is complete (skips trailing tokens)."""
+    stream = client.models.generate_content_stream(model=model_name, contents=contents, config=config)
+    parts: List[str] = []
+    try:
+        for chunk in stream:
+            piece = _chunk_text(chunk)
+            if not piece:
+                continue
+            parts.append(piece)
+            if "}" in piece and _json_complete("".join(parts)):
+                break
+    finally:
+        close = getattr(stream, "close", None)
+        if close:
+            close()
+    return "".join(parts)
+
+async def _a_stream_until_json(client, model_name: str, contents, config) -> str:
+    stream = await client.aio.models.generate_content_stream(model=model_name, contents=contents, config=config)
+    parts: List[str] = []
+    try:
+        async for chunk in stream:
+            piece = _chunk_text(chunk)
+            if not piece:
+                continue
+            parts.append(piece)
+            if "}" in piece and _json_complete("".join(parts)):
+                break
+    finally:
+        aclose = getattr(stream, "aclose", None)
+        if aclose:
+            await aclose()
+    return "".join(parts)
+
+def _call_text(client, model_name: str, contents, config, json_reply: bool) -> str:
+    if json_reply:
+        return _stream_until_json(client, model_name, contents, config)
+    return _response_text(client.models.generate_content(model=model_name, contents=contents, config=config))
+
+async def _a_call_text(client, model_name: str, contents, config, json_reply: bool) -> str:
+    if json_reply:
+        return await _a_stream_until_json(client, model_name, contents, config)
+    return _response_text(await client.aio.models.generate_content(model=model_name, contents=contents, config=config))
+
+def _generate_text(system: str, user: str, model_name: str, json_reply: bool = False,
+                   service_tier: Optional[str] = None) -> str:
+    prompt = f"{system}\n\n{user}"
+    key = _llm_cache.cache_key(model_name, prompt) if _llm_cache.CACHE_ENABLED else None
+    if key:
+        hit = _llm_cache.get(key)
+        if hit is not None:
+            return hit
+
+    text = _call_text(get_client(), model_name, prompt, _text_config(service_tier), json_reply)
+    if key:
+        _llm_cache.put(key, text)
+    return text
+
+async def _a_generate_text(system: str, user: str, model_name: str, json_reply: bool = False,
+                          service_tier: Optional[str] = None) -> str:
+    """Same as _generate_text, but through the async client so the event loop is not blocked."""
+    prompt = f"{system}\n\n{user}"
+    key = _llm_cache.cache_key(model_name, prompt) if _llm_cache.CACHE_ENABLED else None
+    if key:
+        # the Redis tier does blocking socket I/O; keep it off the event loop
+        hit = await asyncio.to_thread(_llm_cache.get, key)
+        if hit is not None:
+            return hit
+
+    text = await _a_call_text(get_client(), model_name, prompt, _text_config(service_tier), json_reply)
+    if key:
+        await asyncio.to_thread(_llm_cache.put, key, text)
+    return text
+
+
 # ---------- Normalization / Generation ----------
 
-def normalize_task(chat: str, defaults: Optional[Dict[str, Any]] = None, model: Optional[str] = None) -> Dict[str, Any]:
-    model_name = model or DEFAULT_TEXT_MODEL
-    system = (
-        "You normalize casual user requests into a compact JSON TaskSpec. "
-        "Return ONLY valid JSON (no code fences). Strict keys: "
-        "topic, audience, language, difficulty, outputs (default ['text','diagram','image']), "
-        "keywords (3-7), image_ideas (1-2), text_depth ('very_detailed' by default), "
-        "min_diagrams (int 0-10), min_images (int 0-10). "
-        "Infer counts from phrasing (e.g., '3 diagrams', 'several images'→3, 'a lot'→3). "
-        "If not stated, default min_diagrams=2 and min_images=2 when the respective output is present."
-    )
-    user = f"User message: ```{chat}```\nReturn ONLY valid JSON without code fences. Start with '{{' and end with '}}'."
-    client = _client()
-    res = client.models.generate_content(
-        model=model_name,
-        contents=f"{system}\n\n{user}",
-        config=types.GenerateContentConfig(response_modalities=["TEXT"]),
-    )
-    text = res.candidates[0].content.parts[0].text if res.candidates else ""
-    data = _extract_json(text)
+_NORMALIZE_SYSTEM = (
+    "You normalize casual user requests into a compact JSON TaskSpec. "
+    "Return ONLY valid JSON (no code fences). Strict keys: "
+    "topic, audience, language, difficulty, outputs (default ['text','diagram','image']), "
+    "keywords (3-7), image_ideas (1-2), text_depth ('very_detailed' by default), "
+    "min_diagrams (int 0-10), min_images (int 0-10). "
+    "Infer counts from phrasing (e.g., '3 diagrams', 'several images'→3, 'a lot'→3). "
+    "If not stated, default min_diagrams=2 and min_images=2 when the respective output is present."
+)
+
+def _normalize_user(chat: str) -> str:
+    return f"User message: ```{chat}```\nReturn ONLY valid JSON without code fences. Start with '{{' and end with '}}'."
+
+def _normalize_tag(chat: str, model_name: str) -> str:
+    # paraphrases only match when model and explicit counts ("3 diagrams") agree
+    return model_name + "|" + " ".join(re.findall(r"\d+", chat))
+
+def _cacheable_task(data: Any) -> bool:
+    return isinstance(data, dict) and "raw" not in data
 
+def _finish_normalize(data: Any, defaults: Optional[Dict[str, Any]]) -> Dict[str, Any]:
     if defaults and isinstance(data, dict):
-        for k, v in defaults.items():
-            data.setdefault(k, v)
+        data = dict(defaults, **data)   # model output wins over defaults
 
     if isinstance(data, dict):
         data.setdefault("outputs", ["text","diagram","image"])
@@ -241,136 +392,296 @@ def normalize_task(chat: str, defaults: Optional[Dict[str, Any]] = None, model:
 
     return data
 
-def generate_lesson(task_spec: Dict[str, Any], helpful_notes: List[str], model: Optional[str] = None) -> Dict[str, Any]:
+def normalize_task(chat: str, defaults: Optional[Dict[str, Any]] = None, model: Optional[str] = None,
+                   service_tier: Optional[str] = None) -> Dict[str, Any]:
     model_name = model or DEFAULT_TEXT_MODEL
-
-    structure_hint = (
-        "Use a clearly structured Markdown layout with headings and subsections. "
-        "Target outline (adapt to the topic):\n"
-        "1. Introduction & Motivation\n"
-        "2. What Is X? (Informal → Formal)\n"
-        "3. Core Terminology\n"
-        "4. Types / Taxonomy\n"
-        "5. Representations / Common Forms\n"
-        "6. Worked Examples\n"
-        "7. Bridge to a Related Concept\n"
-        "8. Guided Tutorial Scenarios\n"
-        "9. Practice Problems\n"
-        "10. Assignments\n"
-        "11. Glossary\n"
-        "12. Common Pitfalls\n"
-        "13. Summary\n"
-        "14. Further Reading\n\n"
-        "Ensure the Markdown in 'segments[].text' is preserved verbatim."
-    )
-    graph_hint = (
-        "If the topic is about Graphs, prefer this deeper outline: "
-        "Introduction & Motivation; What Is a Graph? (Informal → Formal G=(V,E)); "
-        "Core Terminology (Vertices, Edges, Incidence, Degree, Adjacency); "
-        "Types of Graphs (Simple, Multigraph, Pseudograph, Directed, Undirected, Mixed); "
-        "Graph Representations (Adjacency Matrix, Adjacency List, Quick Comparison); "
-        "Worked Examples (Social Network, One-Way Streets); Bridge to Minimal (Vertex) Cover; "
-        "Guided Tutorial Scenarios; Practice Problems; Assignments; Glossary; Common Pitfalls; Summary; Further Reading."
-    )
-    system = (
-        "You create comprehensive, pedagogically sound lessons. "
-        "Use HelpfulNotes to improve correctness, but do not cite them. "
-        "Return ONLY valid JSON (no code fences) with keys: "
-        "title, segments[{section?, kind(content|diagram|image), text(md), text_format='md', mermaid?, image_prompt?, alt_text?}], narration?. "
-        "CRITICAL: Keep Markdown inside 'text' exactly as you generate it; do not escape or convert. "
-        "If 'diagram' is in outputs, include at least 2 segments with valid Mermaid (prefer 'flowchart TD' or 'graph LR'); 'mermaid' MUST be a string containing Mermaid code, not true/false. "
-        "If 'image' is in outputs, include at least 2 segments with precise schematic image prompts; 'image_prompt' MUST be a string, not true/false. "
-        "Diagrams are for explanation; images are aesthetic yet relevant. "
-        "Avoid brittle Mermaid 'style' lines unless confident they render. "
-        "Keep images schematic (not photorealistic). "
-        f"{structure_hint} {graph_hint}"
-    )
-
-    notes_block = "\n".join(helpful_notes[:12])
-    prompt = (
-        f"TaskSpec JSON:\n```json\n{json.dumps(task_spec, ensure_ascii=False)}\n```\n"
+    tag = _normalize_tag(chat, model_name)
+    data = _NORMALIZE_SEMCACHE.get(chat, tag) if _NORMALIZE_SEMCACHE else None
+    if data is None:
+        data = _extract_json(_generate_text(_NORMALIZE_SYSTEM, _normalize_user(chat), model_name, json_reply=True,
+                                            service_tier=service_tier))
+        if _NORMALIZE_SEMCACHE and _cacheable_task(data):
+            _NORMALIZE_SEMCACHE.put(chat, data, tag)
+    return _finish_normalize(data, defaults)
+
+async def a_normalize_task(chat: str, defaults: Optional[Dict[str, Any]] = None, model: Optional[str] = None,
+                           service_tier: Optional[str] = None) -> Dict[str, Any]:
+    model_name = model or DEFAULT_TEXT_MODEL
+    tag = _normalize_tag(chat, model_name)
+    # embedding is CPU work; keep it off the event loop
+    data = await asyncio.to_thread(_NORMALIZE_SEMCACHE.get, chat, tag) if _NORMALIZE_SEMCACHE else None
+    if data is None:
+        data = _extract_json(await _a_generate_text(_NORMALIZE_SYSTEM, _normalize_user(chat), model_name, json_reply=True,
+                                                    service_tier=service_tier))
+        if _NORMALIZE_SEMCACHE and _cacheable_task(data):
+            await asyncio.to_thread(_NORMALIZE_SEMCACHE.put, chat, data, tag)
+    return _finish_normalize(data, defaults)
+
+_LESSON_STRUCTURE_HINT = (
+    "Use a clearly structured Markdown layout with headings and subsections. "
+    "Target outline (adapt to the topic):\n"
+    "1. Introduction & Motivation\n"
+    "2. What Is X? (Informal → Formal)\n"
+    "3. Core Terminology\n"
+    "4. Types / Taxonomy\n"
+    "5. Representations / Common Forms\n"
+    "6. Worked Examples\n"
+    "7. Bridge to a Related Concept\n"
+    "8. Guided Tutorial Scenarios\n"
+    "9. Practice Problems\n"
+    "10. Assignments\n"
+    "11. Glossary\n"
+    "12. Common Pitfalls\n"
+    "13. Summary\n"
+    "14. Further Reading\n\n"
+    "Ensure the Markdown in 'segments[].text' is preserved verbatim."
+)
+_LESSON_GRAPH_HINT = (
+    "If the topic is about Graphs, prefer this deeper outline: "
+    "Introduction & Motivation; What Is a Graph? (Informal → Formal G=(V,E)); "
+    "Core Terminology (Vertices, Edges, Incidence, Degree, Adjacency); "
+    "Types of Graphs (Simple, Multigraph, Pseudograph, Directed, Undirected, Mixed); "
+    "Graph Representations (Adjacency Matrix, Adjacency List, Quick Comparison); "
+    "Worked Examples (Social Network, One-Way Streets); Bridge to Minimal (Vertex) Cover; "
+    "Guided Tutorial Scenarios; Practice Problems; Assignments; Glossary; Common Pitfalls; Summary; Further Reading."
+)
+_LESSON_SYSTEM = (
+    "You create comprehensive, pedagogically sound lessons. "
+    "Use HelpfulNotes to improve correctness, but do not cite them. "
+    "Return ONLY valid JSON (no code fences) with keys: "
+    "title, segments[{section?, kind(content|diagram|image), text(md), text_format='md', mermaid?, image_prompt?, alt_text?}], narration?. "
+    "CRITICAL: Keep Markdown inside 'text' exactly as you generate it; do not escape or convert. "
+    "If 'diagram' is in outputs, include at least 2 segments with valid Mermaid (prefer 'flowchart TD' or 'graph LR'); 'mermaid' MUST be a string containing Mermaid code, not true/false. "
+    "If 'image' is in outputs, include at least 2 segments with precise schematic image prompts; 'image_prompt' MUST be a string, not true/false. "
+    "Diagrams are for explanation; images are aesthetic yet relevant. "
+    "Avoid brittle Mermaid 'style' lines unless confident they render. "
+    "Keep images schematic (not photorealistic). "
+    f"{_LESSON_STRUCTURE_HINT} {_LESSON_GRAPH_HINT}"
+)
+
+def _join_notes(helpful_notes: List[str], limit: int, notes_block: Optional[str]) -> str:
+    # endpoints making several LLM calls join the notes once and pass the block in
+    return notes_block if notes_block is not None else "\n".join(helpful_notes[:limit])
+
+def _lesson_user(task_spec: Dict[str, Any], helpful_notes: List[str], notes_block: Optional[str] = None) -> str:
+    notes_block = _join_notes(helpful_notes, 12, notes_block)
+    return (
+        f"TaskSpec JSON:\n```json\n{orjson.dumps(task_spec, default=str).decode()}\n```\n"
         f"HelpfulNotes (optional):\n{notes_block}\n\n"
         "Produce the lesson now. Return ONLY valid JSON without code fences. Start with '{' and end with '}'."
     )
 
-    client = _client()
-    res = client.models.generate_content(
-        model=model_name,
-        contents=f"{system}\n\n{prompt}",
-        config=types.GenerateContentConfig(response_modalities=["TEXT"]),
-    )
-    text = res.candidates[0].content.parts[0].text if res.candidates else ""
-    data = _extract_json(text)
+def generate_lesson(task_spec: Dict[str, Any], helpful_notes: List[str], model: Optional[str] = None,
+                    notes_block: Optional[str] = None, service_tier: Optional[str] = None) -> Dict[str, Any]:
+    text = _generate_text(_LESSON_SYSTEM, _lesson_user(task_spec, helpful_notes, notes_block), model or DEFAULT_TEXT_MODEL,
+                          json_reply=True, service_tier=service_tier)
     # sanitize before returning
-    return sanitize_lesson(data)
+    return sanitize_lesson(_extract_json(text))
+
+async def a_generate_lesson(task_spec: Dict[str, Any], helpful_notes: List[str], model: Optional[str] = None,
+                            notes_block: Optional[str] = None, service_tier: Optional[str] = None) -> Dict[str, Any]:
+    text = await _a_generate_text(_LESSON_SYSTEM, _lesson_user(task_spec, helpful_notes, notes_block), model or DEFAULT_TEXT_MODEL,
+                                  json_reply=True, service_tier=service_tier)
+    return sanitize_lesson(_extract_json(text))
 
 # ---------- LLM fallbacks ----------
 
-def gen_mermaid_snippet(task_spec: Dict[str, Any], helpful_notes: List[str], model: Optional[str] = None) -> str:
-    model_name = model or DEFAULT_TEXT_MODEL
+_MERMAID_SYSTEM = (
+    "Produce ONLY a valid, small Mermaid diagram that teaches the topic with high relevance. "
+    "Prefer 'flowchart TD' or 'graph LR'. No narrative text. No code fences. "
+    "Avoid fragile 'style' lines unless necessary."
+)
+_FALLBACK_MERMAID = "flowchart TD\nA[Start]-->B[Concept 1]\nB-->C[Concept 2]\nC-->D[End]"
+
+def _variant_hint(variant: int, what: str) -> str:
+    # distinct prompts for repeated fallbacks, so they neither repeat nor share a cache entry
+    return f"\nVariant #{variant + 1}: cover a different aspect than the previous {what}." if variant > 0 else ""
+
+def _mermaid_user(task_spec: Dict[str, Any], helpful_notes: List[str], variant: int = 0,
+                  notes_block: Optional[str] = None) -> str:
     topic = task_spec.get("topic") or "the topic"
-    notes = "\n".join(helpful_notes[:8])
-    system = (
-        "Produce ONLY a valid, small Mermaid diagram that teaches the topic with high relevance. "
-        "Prefer 'flowchart TD' or 'graph LR'. No narrative text. No code fences. "
-        "Avoid fragile 'style' lines unless necessary."
-    )
-    user = (
+    notes = _join_notes(helpful_notes, 8, notes_block)
+    return (
         f"Topic: {topic}\nHelpfulNotes (optional):\n{notes}\n\n"
         "Constraints:\n- Compact and valid Mermaid\n- Simple nodes/edges with brief labels\n- Output Mermaid only"
+        f"{_variant_hint(variant, 'diagrams')}"
     )
-    client = _client()
-    res = client.models.generate_content(
-        model=model_name,
-        contents=f"{system}\n\n{user}",
-        config=types.GenerateContentConfig(response_modalities=["TEXT"]),
-    )
-    txt = res.candidates[0].content.parts[0].text if res.candidates else ""
-    mer = _extract_mermaid(txt) or "flowchart TD\nA[Start]-->B[Concept 1]\nB-->C[Concept 2]\nC-->D[End]"
-    return mer
 
-def gen_image_prompt(task_spec: Dict[str, Any], helpful_notes: List[str], model: Optional[str] = None) -> str:
-    model_name = model or DEFAULT_TEXT_MODEL
+def gen_mermaid_snippet(task_spec: Dict[str, Any], helpful_notes: List[str], model: Optional[str] = None,
+                        variant: int = 0, notes_block: Optional[str] = None) -> str:
+    txt = _generate_text(_MERMAID_SYSTEM, _mermaid_user(task_spec, helpful_notes, variant, notes_block),
+                         model or DEFAULT_TEXT_MODEL)
+    return _extract_mermaid(txt) or _FALLBACK_MERMAID
+
+async def a_gen_mermaid_snippet(task_spec: Dict[str, Any], helpful_notes: List[str], model: Optional[str] = None,
+                                variant: int = 0, notes_block: Optional[str] = None) -> str:
+    txt = await _a_generate_text(_MERMAID_SYSTEM, _mermaid_user(task_spec, helpful_notes, variant, notes_block),
+                                 model or DEFAULT_TEXT_MODEL)
+    return _extract_mermaid(txt) or _FALLBACK_MERMAID
+
+_IMAGE_SYSTEM = (
+    "Return ONLY one line of text: a clean 2D vector schematic prompt (not a photo). "
+    "Style: flat, minimal, white background, thin black outlines, limited accent colors, "
+    "clear labels/arrows, resolution ~1024x1024. No people or scenery. "
+    "It should be aesthetically pleasing but still relevant to the topic."
+)
+
+def _image_user(task_spec: Dict[str, Any], helpful_notes: List[str], variant: int = 0,
+                notes_block: Optional[str] = None) -> str:
     topic = task_spec.get("topic") or "the topic"
-    notes = "\n".join(helpful_notes[:8])
-    system = (
-        "Return ONLY one line of text: a clean 2D vector schematic prompt (not a photo). "
-        "Style: flat, minimal, white background, thin black outlines, limited accent colors, "
-        "clear labels/arrows, resolution ~1024x1024. No people or scenery. "
-        "It should be aesthetically pleasing but still relevant to the topic."
-    )
-    user = (
+    notes = _join_notes(helpful_notes, 8, notes_block)
+    return (
         f"Topic: {topic}\nHelpfulNotes (optional):\n{notes}\n\n"
         "Return one line describing the schematic content, precise and labeled."
+        f"{_variant_hint(variant, 'images')}"
     )
-    client = _client()
-    res = client.models.generate_content(
-        model=model_name,
-        contents=f"{system}\n\n{user}",
-        config=types.GenerateContentConfig(response_modalities=["TEXT"]),
-    )
-    text = res.candidates[0].content.parts[0].text if res.candidates else ""
+
+def _finish_image_prompt(text: str, task_spec: Dict[str, Any]) -> str:
+    topic = task_spec.get("topic") or "the topic"
     line = " ".join((text or "").strip().split())
     return line or f"clean 2D vector schematic of {topic}, white background, thin black outlines, clear labels"
 
-def repair_mermaid(mermaid_code: str, error_log: Optional[str] = None, topic: Optional[str] = None,
-                   model: Optional[str] = None) -> str:
+def _cached_image_prompt(topic: str, tag: str, variant: int) -> Optional[str]:
+    lines = _IMAGE_SEMCACHE.get(topic, tag) or []
+    return lines[variant] if variant < len(lines) else None
+
+def _remember_image_prompt(topic: str, tag: str, variant: int, line: str) -> None:
+    lines = _IMAGE_SEMCACHE.get(topic, tag) or []
+    if len(lines) == variant:
+        _IMAGE_SEMCACHE.put(topic, lines + [line], tag)
+
+def gen_image_prompt(task_spec: Dict[str, Any], helpful_notes: List[str], model: Optional[str] = None,
+                     variant: int = 0, notes_block: Optional[str] = None) -> str:
+    model_name = model or DEFAULT_TEXT_MODEL
+    topic = task_spec.get("topic")
+    use_cache = bool(_IMAGE_SEMCACHE and topic)
+    if use_cache:
+        hit = _cached_image_prompt(topic, model_name, variant)
+        if hit:
+            return hit
+    text = _generate_text(_IMAGE_SYSTEM, _image_user(task_spec, helpful_notes, variant, notes_block), model_name)
+    if use_cache and text and text.strip():
+        _remember_image_prompt(topic, model_name, variant, _finish_image_prompt(text, task_spec))
+    return _finish_image_prompt(text, task_spec)
+
+async def a_gen_image_prompt(task_spec: Dict[str, Any], helpful_notes: List[str], model: Optional[str] = None,
+                             variant: int = 0, notes_block: Optional[str] = None) -> str:
     model_name = model or DEFAULT_TEXT_MODEL
-    sysmsg = (
-        "You repair Mermaid diagrams. Output ONLY Mermaid code (no fences). "
-        "Use 'flowchart TD' or 'graph LR'. Remove fragile 'style' lines. Keep it small and valid."
+    topic = task_spec.get("topic")
+    use_cache = bool(_IMAGE_SEMCACHE and topic)
+    if use_cache:
+        hit = await asyncio.to_thread(_cached_image_prompt, topic, model_name, variant)
+        if hit:
+            return hit
+    text = await _a_generate_text(_IMAGE_SYSTEM, _image_user(task_spec, helpful_notes, variant, notes_block), model_name)
+    if use_cache and text and text.strip():
+        await asyncio.to_thread(_remember_image_prompt, topic, model_name, variant, _finish_image_prompt(text, task_spec))
+    return _finish_image_prompt(text, task_spec)
+
+_MERMAID_BATCH_SYSTEM = (
+    "Produce several DISTINCT, small, valid Mermaid diagrams that teach the topic with high relevance; "
+    "each one should explain a different aspect. Prefer 'flowchart TD' or 'graph LR'. "
+    "Avoid fragile 'style' lines unless necessary. "
+    "Return ONLY valid JSON (no code fences): {\"diagrams\": [\"<mermaid code>\", ...]}."
+)
+
+def _mermaid_batch_user(task_spec: Dict[str, Any], helpful_notes: List[str], n: int, variant: int = 0,
+                        notes_block: Optional[str] = None) -> str:
+    return (
+        _mermaid_user(task_spec, helpful_notes, variant, notes_block)
+        + f"\n\nReturn exactly {n} diagrams in the 'diagrams' array."
+    )
+
+def _finish_mermaid_batch(text: str, n: int) -> List[str]:
+    data = _extract_json(text)
+    raw = data.get("diagrams") if isinstance(data, dict) else None
+    mers = [m for m in (_extract_mermaid(d) for d in (raw if isinstance(raw, list) else [])) if m]
+    mers = mers[:n]
+    return mers + [_FALLBACK_MERMAID] * (n - len(mers))
+
+def gen_mermaid_snippets(task_spec: Dict[str, Any], helpful_notes: List[str], n: int,
+                         model: Optional[str] = None, variant: int = 0,
+                         notes_block: Optional[str] = None) -> List[str]:
+    """n fallback diagrams from a single Gemini call."""
+    if n < 1:
+        return []
+    if n == 1:
+        return [gen_mermaid_snippet(task_spec, helpful_notes, model=model, variant=variant, notes_block=notes_block)]
+    text = _generate_text(_MERMAID_BATCH_SYSTEM, _mermaid_batch_user(task_spec, helpful_notes, n, variant, notes_block),
+                          model or DEFAULT_TEXT_MODEL, json_reply=True)
+    return _finish_mermaid_batch(text, n)
+
+async def a_gen_mermaid_snippets(task_spec: Dict[str, Any], helpful_notes: List[str], n: int,
+                                 model: Optional[str] = None, variant: int = 0,
+                                 notes_block: Optional[str] = None) -> List[str]:
+    if n < 1:
+        return []
+    if n == 1:
+        return [await a_gen_mermaid_snippet(task_spec, helpful_notes, model=model, variant=variant,
+                                            notes_block=notes_block)]
+    text = await _a_generate_text(_MERMAID_BATCH_SYSTEM, _mermaid_batch_user(task_spec, helpful_notes, n, variant, notes_block),
+                                  model or DEFAULT_TEXT_MODEL, json_reply=True)
+    return _finish_mermaid_batch(text, n)
+
+_FUSED_SYSTEM = (
+    "Produce one small teaching diagram and one image prompt for the topic. "
+    "Return ONLY valid JSON (no code fences) with keys 'mermaid' and 'image_prompt'. "
+    "'mermaid': a valid, compact Mermaid string (prefer 'flowchart TD' or 'graph LR'; no fences; "
+    "avoid fragile 'style' lines). "
+    "'image_prompt': ONE line describing a clean 2D vector schematic (not a photo): flat, minimal, "
+    "white background, thin black outlines, limited accent colors, clear labels/arrows, ~1024x1024, "
+    "no people or scenery; aesthetically pleasing but relevant."
+)
+
+def _fused_user(task_spec: Dict[str, Any], helpful_notes: List[str], variant: int = 0,
+                notes_block: Optional[str] = None) -> str:
+    topic = task_spec.get("topic") or "the topic"
+    notes = _join_notes(helpful_notes, 8, notes_block)
+    return (
+        f"Topic: {topic}\nHelpfulNotes (optional):\n{notes}\n\n"
+        "Return ONLY valid JSON without code fences. Start with '{' and end with '}'."
+        f"{_variant_hint(variant, 'diagrams and images')}"
     )
-    user = (
+
+def _finish_fused(text: str, task_spec: Dict[str, Any]) -> Tuple[str, str]:
+    data = _extract_json(text)
+    data = data if isinstance(data, dict) else {}
+    mer = _extract_mermaid(data.get("mermaid")) or _FALLBACK_MERMAID
+    ip = data.get("image_prompt")
+    return mer, _finish_image_prompt(ip if isinstance(ip, str) else "", task_spec)
+
+def gen_mermaid_and_image(task_spec: Dict[str, Any], helpful_notes: List[str], model: Optional[str] = None,
+                          variant: int = 0, notes_block: Optional[str] = None) -> Tuple[str, str]:
+    """(mermaid, image_prompt) from one Gemini call instead of two."""
+    text = _generate_text(_FUSED_SYSTEM, _fused_user(task_spec, helpful_notes, variant, notes_block), model or DEFAULT_TEXT_MODEL,
+                          json_reply=True)
+    return _finish_fused(text, task_spec)
+
+async def a_gen_mermaid_and_image(task_spec: Dict[str, Any], helpful_notes: List[str], model: Optional[str] = None,
+                                  variant: int = 0, notes_block: Optional[str] = None) -> Tuple[str, str]:
+    text = await _a_generate_text(_FUSED_SYSTEM, _fused_user(task_spec, helpful_notes, variant, notes_block), model or DEFAULT_TEXT_MODEL,
+                                  json_reply=True)
+    return _finish_fused(text, task_spec)
+
+_REPAIR_SYSTEM = (
+    "You repair Mermaid diagrams. Output ONLY Mermaid code (no fences). "
+    "Use 'flowchart TD' or 'graph LR'. Remove fragile 'style' lines. Keep it small and valid."
+)
+
+def _repair_user(mermaid_code: str, error_log: Optional[str], topic: Optional[str]) -> str:
+    return (
         f"Topic: {topic or ''}\n"
         f"Broken Mermaid:\n{mermaid_code}\n"
         f"Renderer stderr (optional):\n{(error_log or '').strip()}\n\n"
         "Return fixed Mermaid only."
     )
-    client = _client()
-    res = client.models.generate_content(
-        model=model_name,
-        contents=f"{sysmsg}\n\n{user}",
-        config=types.GenerateContentConfig(response_modalities=["TEXT"]),
-    )
-    text = res.candidates[0].content.parts[0].text if res.candidates else ""
+
+def repair_mermaid(mermaid_code: str, error_log: Optional[str] = None, topic: Optional[str] = None,
+                   model: Optional[str] = None) -> str:
+    text = _generate_text(_REPAIR_SYSTEM, _repair_user(mermaid_code, error_log, topic), model or DEFAULT_TEXT_MODEL)
+    return _extract_mermaid(text) or mermaid_code
+
+async def a_repair_mermaid(mermaid_code: str, error_log: Optional[str] = None, topic: Optional[str] = None,
+                           model: Optional[str] = None) -> str:
+    text = await _a_generate_text(_REPAIR_SYSTEM, _repair_user(mermaid_code, error_log, topic), model or DEFAULT_TEXT_MODEL)
     return _extract_mermaid(text) or mermaid_code
@@ -1,5 +1,6 @@
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 
 from .schemas import (
@@ -7,19 +8,45 @@ from .schemas import (
     ChunkPayload, GenerateRequest, LessonDraft, FullLessonRequest,
     LessonWithAssets, EnrichedLessonSegment
 )
-from retrieval.hybrid_search import hybrid_search
+from retrieval.hybrid_search import hybrid_search, cached_hybrid_search, dedupe_queries
 from retrieval.summarize import summarize_to_notes
 
 from .llm_gateway import (
-    normalize_task, generate_lesson, sanitize_lesson,
-    gen_mermaid_snippet, gen_image_prompt, repair_mermaid
+    sanitize_lesson, a_normalize_task, a_generate_lesson,
+    a_gen_mermaid_snippets, a_gen_image_prompt, a_gen_mermaid_and_image, a_repair_mermaid
 )
-from .media.pipeline import render_assets_for_lesson
-from .media.mermaid import render_mermaid
+from .media.pipeline import a_render_assets_for_lesson, a_iter_assets_for_lesson
+from .media.mermaid import a_render_mermaid
 
-import os, uuid
+import asyncio, os, re, uuid
+import orjson
 
-app = FastAPI(title="UGTA Pipeline API", version="0.1.0")
+# the user waits on normalize + lesson in /lesson*, so those two calls go out on Gemini's priority tier
+INTERACTIVE_TIER = os.getenv("GEMINI_INTERACTIVE_TIER", "priority") or None
+
+# artifact paths only need "\\" → "/" for URLs on Windows
+_FIX_SEP = os.sep == "\\"
+
+
+class ImmutableStaticFiles(StaticFiles):
+    """
+    Artifacts are never rewritten (fresh uuid run folder per lesson, content-hashed
+    _cache entries), so clients may keep them forever. FileResponse already
+    supplies ETag / Last-Modified and 304s.
+    """
+    async def get_response(self, path: str, scope):
+        response = await super().get_response(path, scope)
+        if response.status_code in (200, 304):
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
+
+
+# Every route declares a response_model. Newer FastAPI serializes those straight to JSON
+# bytes via Pydantic (and deprecates ORJSONResponse; setting any default class would turn
+# that fast path off); on older releases orjson beats the stdlib json.dumps path.
+_RESPONSE_CLASS = {} if getattr(ORJSONResponse, "__deprecated__", None) else {"default_response_class": ORJSONResponse}
+
+app = FastAPI(title="UGTA Pipeline API", version="0.1.0", **_RESPONSE_CLASS)
 
 app.add_middleware(
     CORSMiddleware,
@@ -29,14 +56,14 @@ app.add_middleware(
 )
 
 os.makedirs("artifacts", exist_ok=True)
-app.mount("/artifacts", StaticFiles(directory="artifacts"), name="artifacts")
+app.mount("/artifacts", ImmutableStaticFiles(directory="artifacts"), name="artifacts")
 
 
 @app.post("/normalize", response_model=TaskSpec)
-def api_normalize(req: NormalizeRequest):
+async def api_normalize(req: NormalizeRequest):
     try:
-        data = normalize_task(req.chat, defaults=req.defaults or {})
-        return TaskSpec(**data)
+        data = await a_normalize_task(req.chat, defaults=req.defaults or {}, service_tier=req.service_tier)
+        return TaskSpec.model_validate(data)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -61,29 +88,54 @@ def api_helpful_notes(req: HelpfulNotesRequest):
 
 
 @app.post("/generate", response_model=LessonDraft)
-def api_generate(req: GenerateRequest):
+async def api_generate(req: GenerateRequest):
     try:
         # sanitize inside generate_lesson already, but keep consistent
-        lesson = generate_lesson(task_spec=req.task_spec.dict(), helpful_notes=req.helpful_notes, model=req.model)
+        lesson = await a_generate_lesson(task_spec=req.task_spec.model_dump(), helpful_notes=req.helpful_notes, model=req.model,
+                                         service_tier=req.service_tier)
         lesson = sanitize_lesson(lesson)
-        return LessonDraft(**lesson)
+        return LessonDraft.model_validate(lesson)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-def _top_up_assets_with_llm(lesson: dict, task: TaskSpec, notes: list, model: str | None):
+async def _top_up_assets_with_llm(lesson: dict, task_dict: dict, notes: list, model: str | None,
+                                  notes_block: str | None = None):
     # sanitize first so booleans become None and don’t break counters
     lesson = sanitize_lesson(lesson)
     segs = list(lesson.get("segments", []))
 
-    count_merm = sum(1 for s in segs if isinstance(s.get("mermaid"), str) and s["mermaid"].strip())
-    count_img  = sum(1 for s in segs if isinstance(s.get("image_prompt"), str) and s["image_prompt"].strip())
-
-    target_merm = max(0, int(getattr(task, "min_diagrams", 2)))
-    target_img  = max(0, int(getattr(task, "min_images", 2)))
-
-    while count_merm < target_merm:
-        m = gen_mermaid_snippet(task.dict(), notes, model=model)
+    target_merm = max(0, int(task_dict.get("min_diagrams", 2)))
+    target_img  = max(0, int(task_dict.get("min_images", 2)))
+
+    # one pass for both counts; stop as soon as both targets are met
+    count_merm = count_img = 0
+    for s in segs:
+        if count_merm >= target_merm and count_img >= target_img:
+            break
+        m, ip = s.get("mermaid"), s.get("image_prompt")
+        if isinstance(m, str) and m.strip():
+            count_merm += 1
+        if isinstance(ip, str) and ip.strip():
+            count_img += 1
+
+    # all fallbacks are independent Gemini round trips → fire them together, and
+    # ask for a diagram+image pair (or a batch of diagrams) per call where possible
+    need_merm = max(0, target_merm - count_merm)
+    need_img  = max(0, target_img - count_img)
+    pairs = min(need_merm, need_img)
+    extra_merm, extra_img = need_merm - pairs, need_img - pairs
+    results = await asyncio.gather(
+        *[a_gen_mermaid_and_image(task_dict, notes, model=model, variant=k, notes_block=notes_block)
+          for k in range(pairs)],
+        a_gen_mermaid_snippets(task_dict, notes, extra_merm, model=model, variant=pairs, notes_block=notes_block),
+        *[a_gen_image_prompt(task_dict, notes, model=model, variant=pairs + k, notes_block=notes_block)
+          for k in range(extra_img)],
+    )
+    mermaids = [m for m, _ in results[:pairs]] + results[pairs]
+    images = [ip for _, ip in results[:pairs]] + list(results[pairs + 1:])
+
+    for m in mermaids:
         segs.append({
             "section": "Auto-added Diagram",
             "kind": "diagram",
@@ -93,10 +145,8 @@ def _top_up_assets_with_llm(lesson: dict, task: TaskSpec, notes: list, model: st
             "image_prompt": None,
             "alt_text": "Diagram explaining a key concept of the topic."
         })
-        count_merm += 1
 
-    while count_img < target_img:
-        ip = gen_image_prompt(task.dict(), notes, model=model)
+    for ip in images:
         segs.append({
             "section": "Auto-added Image",
             "kind": "image",
@@ -106,102 +156,223 @@ def _top_up_assets_with_llm(lesson: dict, task: TaskSpec, notes: list, model: st
             "image_prompt": ip,
             "alt_text": "Schematic image for the topic."
         })
-        count_img += 1
 
     # sanitize again (just in case)
     lesson["segments"] = segs
     return sanitize_lesson(lesson)
 
 
-@app.post("/lesson", response_model=LessonDraft)
-def api_full_lesson(req: FullLessonRequest):
+async def _repair_and_render(seg: dict, i: int, ddir: str, topic: str | None, model: str | None):
+    """Ask Gemini to fix one failed diagram and re-render it (runs concurrently per segment)."""
+    fixed = await a_repair_mermaid(seg["mermaid"], error_log=None, topic=topic, model=model)
+    if fixed and fixed.strip() != seg["mermaid"].strip():
+        seg["mermaid"] = fixed
+        dpath = os.path.join(ddir, f"diagram_{i}.png")
+        ok = await a_render_mermaid(fixed, dpath)
+        seg["diagram_path"] = dpath if ok else ""
+
+
+_WORD_RE = re.compile(r"[a-z0-9]+")
+
+
+def _lesson_queries(task: TaskSpec, chat: str) -> list:
+    queries = [task.topic] if task.topic else []
+    queries.extend(task.keywords[:5])
+    # topic often reappears among the keywords, sometimes in another case
+    return dedupe_queries(queries) or [chat]
+
+
+def _speculation_holds(chat: str, queries: list) -> bool:
     """
-    chat → TaskSpec → HelpfulNotes → LessonDraft (JSON only)
-    Guarantees: ≥min_diagrams Mermaid + ≥min_images image prompts.
+    Chunks retrieved for the raw chat are only good enough when the chat already spells out
+    every refined query (topic and keywords); otherwise the keywords would never be searched.
     """
+    chat_words = set(_WORD_RE.findall(chat.lower()))
+    query_words = set(_WORD_RE.findall(" ".join(queries).lower()))
+    return bool(query_words) and query_words <= chat_words
+
+
+def _retrieve_chunks(queries: list) -> list:
+    return cached_hybrid_search(queries=queries, k_final=10, k_mmr=20, lambda_mmr=0.6)
+
+
+async def _task_and_notes(req: FullLessonRequest):
+    """
+    Normalize the chat and fetch HelpfulNotes. Retrieval starts speculatively on the raw
+    chat while Gemini normalizes; it is redone with the refined queries unless the
+    normalized topic and keywords all turn out to be in the chat.
+    Returns (task_dict, notes).
+    """
+    norm = asyncio.create_task(a_normalize_task(req.chat, defaults={"language": "en"}, model=req.model,
+                                                service_tier=INTERACTIVE_TIER))
+    spec = asyncio.create_task(asyncio.to_thread(_retrieve_chunks, [req.chat]))
+    # a discarded speculation must not log "exception was never retrieved"
+    spec.add_done_callback(lambda t: t.cancelled() or t.exception())
     try:
-        # 1) normalize (Gemini #1)
-        ts = normalize_task(req.chat, defaults={"language": "en"}, model=req.model)
-        task = TaskSpec(**ts)
-
-        # 2) helpful notes
-        queries = [task.topic] if task.topic else []
-        queries.extend(task.keywords[:5])
-        if not queries:
-            queries = [req.chat]
-        chunks = hybrid_search(queries=queries, k_final=10, k_mmr=20, lambda_mmr=0.6)
-        notes = summarize_to_notes(chunks, max_bullets=12, max_chars_per_bullet=220)
+        ts = await norm
+    except Exception:
+        spec.cancel()
+        raise
+    task = TaskSpec.model_validate(ts)
+    task_dict = task.model_dump()   # once; reused by every LLM helper downstream
+
+    queries = _lesson_queries(task, req.chat)
+    if queries == [req.chat] or _speculation_holds(req.chat, queries):
+        chunks = await spec
+    else:
+        spec.cancel()
+        chunks = await asyncio.to_thread(_retrieve_chunks, queries)
+    notes = summarize_to_notes(chunks, max_bullets=12, max_chars_per_bullet=220)
+    return task_dict, notes
+
+
+async def _draft_lesson(req: FullLessonRequest):
+    """Steps shared by every /lesson* endpoint. Returns (task_dict, sanitized lesson dict with asset targets met)."""
+    # 1) normalize (Gemini #1) + 2) helpful notes
+    task_dict, notes = await _task_and_notes(req)
+    notes_block_12 = "\n".join(notes[:12])   # lesson prompt
+    notes_block_8 = "\n".join(notes[:8])     # every fallback prompt
+
+    # 3) lesson (Gemini #2)
+    lesson = await a_generate_lesson(task_spec=task_dict, helpful_notes=notes, model=req.model,
+                                     notes_block=notes_block_12, service_tier=INTERACTIVE_TIER)
 
-        # 3) lesson (Gemini #2)
-        lesson = generate_lesson(task_spec=task.dict(), helpful_notes=notes, model=req.model)
+    # 4) ensure targets and sanitize
+    lesson = await _top_up_assets_with_llm(lesson, task_dict, notes, req.model, notes_block_8)
+    return task_dict, lesson
 
-        # 4) ensure targets and sanitize
-        lesson = _top_up_assets_with_llm(lesson, task, notes, req.model)
 
-        return LessonDraft(**lesson)
+def _new_run_root() -> str:
+    return os.path.join("artifacts", str(uuid.uuid4())[:8])
+
+
+def _public_url(base: str, path: str) -> str:
+    return base + (path.replace("\\", "/") if _FIX_SEP else path)
+
+
+def _failed_diagrams(segs: list) -> list:
+    return [i for i, seg in enumerate(segs)
+            if isinstance(seg.get("mermaid"), str) and seg["mermaid"].strip() and not seg.get("diagram_path")]
+
+
+def _with_assets(lesson: dict, base: str, out_root: str) -> LessonWithAssets:
+    # add public URLs (base computed once, one pass over segments)
+    for seg in lesson.get("segments", []):
+        p, ip = seg.get("diagram_path"), seg.get("image_path")
+        if p:
+            seg["diagram_url"] = _public_url(base, p)
+        if ip:
+            seg["image_url"] = _public_url(base, ip)
+
+    # validated like /lesson's LessonDraft, so every endpoint returns the same contract
+    return LessonWithAssets.model_validate({
+        "title": lesson.get("title") or "",
+        "segments": lesson.get("segments", []),
+        "narration": lesson.get("narration"),
+        "artifacts_root": out_root,
+    })
+
+
+@app.post("/lesson", response_model=LessonDraft)
+async def api_full_lesson(req: FullLessonRequest):
+    """
+    chat → TaskSpec → HelpfulNotes → LessonDraft (JSON only)
+    Guarantees: ≥min_diagrams Mermaid + ≥min_images image prompts.
+    """
+    try:
+        _, lesson = await _draft_lesson(req)
+        return LessonDraft.model_validate(lesson)
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.post("/lesson_rendered", response_model=LessonWithAssets)
-def api_full_lesson_rendered(req: FullLessonRequest, request: Request):
+async def api_full_lesson_rendered(req: FullLessonRequest, request: Request):
     """
     chat → TaskSpec → HelpfulNotes → LessonDraft → render Mermaid + Images
     Images generated in parallel (max 5). Ensures ≥ min_diagrams & ≥ min_images.
-    Repairs broken Mermaid once if needed.
+    Repairs broken Mermaid once if needed (all failed diagrams in parallel).
     """
     try:
-        # 1) normalize
-        ts = normalize_task(req.chat, defaults={"language": "en"}, model=req.model)
-        task = TaskSpec(**ts)
-
-        # 2) helpful notes
-        queries = [task.topic] if task.topic else []
-        queries.extend(task.keywords[:5])
-        if not queries:
-            queries = [req.chat]
-        chunks = hybrid_search(queries=queries, k_final=10, k_mmr=20, lambda_mmr=0.6)
-        notes = summarize_to_notes(chunks, max_bullets=12, max_chars_per_bullet=220)
-
-        # 3) lesson draft
-        lesson = generate_lesson(task_spec=task.dict(), helpful_notes=notes, model=req.model)
-        lesson = _top_up_assets_with_llm(lesson, task, notes, req.model)
+        # 1-3) normalize, helpful notes, lesson draft
+        task_dict, lesson = await _draft_lesson(req)
 
         # 4) render assets
-        run_id = str(uuid.uuid4())[:8]
-        out_root = os.path.join("artifacts", run_id)
-        enriched = render_assets_for_lesson(lesson, out_root=out_root, image_concurrency=5)
+        out_root = _new_run_root()
+        enriched = await a_render_assets_for_lesson(lesson, out_root=out_root, image_concurrency=5,
+                                                    topic=task_dict.get("topic"))
 
         # 5) repair failed diagrams once
-        for i, seg in enumerate(enriched.get("segments", [])):
-            if isinstance(seg.get("mermaid"), str) and seg["mermaid"].strip():
-                if not seg.get("diagram_path"):
-                    fixed = repair_mermaid(seg["mermaid"], error_log=None, topic=lesson.get("title"), model=req.model)
-                    if fixed and fixed.strip() != seg["mermaid"].strip():
-                        seg["mermaid"] = fixed
-                        ddir = os.path.join(out_root, "diagrams"); os.makedirs(ddir, exist_ok=True)
-                        dpath = os.path.join(ddir, f"diagram_{i}.png")
-                        ok = render_mermaid(fixed, dpath)
-                        seg["diagram_path"] = dpath if ok else ""
-
-        # 6) add public URLs
-        base = str(request.base_url).rstrip("/")
-        for seg in enriched.get("segments", []):
-            p = seg.get("diagram_path")
-            if p:
-                seg["diagram_url"] = f"{base}/{p.replace('\\', '/')}"
-            ip = seg.get("image_path")
-            if ip:
-                seg["image_url"] = f"{base}/{ip.replace('\\', '/')}"
-
-        segs_out = [EnrichedLessonSegment(**seg) for seg in enriched.get("segments", [])]
-        return LessonWithAssets(
-            title=enriched.get("title", ""),
-            segments=segs_out,
-            narration=enriched.get("narration"),
-            artifacts_root=out_root
-        )
+        ddir = os.path.join(out_root, "diagrams")
+        os.makedirs(ddir, exist_ok=True)
+        segs = enriched.get("segments", [])
+        await asyncio.gather(*[
+            _repair_and_render(segs[i], i, ddir, lesson.get("title"), req.model) for i in _failed_diagrams(segs)
+        ])
+
+        # 6) public URLs
+        return _with_assets(enriched, str(request.base_url).rstrip("/") + "/", out_root)
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
+
+def _sse(event: str, data) -> bytes:
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
+
+@app.post("/lesson_rendered_stream")
+async def api_full_lesson_rendered_stream(req: FullLessonRequest, request: Request):
+    """
+    Same pipeline as /lesson_rendered, streamed as Server-Sent Events so the text is
+    usable while assets render:
+      event: lesson   → LessonDraft JSON + artifacts_root, as soon as the text is ready
+      event: diagram  → {"idx", "mermaid", "diagram_path", "diagram_url"} per diagram
+                        (failed ones after their repair attempt; path "" if still broken)
+      event: image    → {"idx", "image_path", "image_url"} per image, in completion order
+      event: done     → the full LessonWithAssets
+    Errors before the lesson is ready are a plain HTTP 500; later ones arrive as event: error.
+    """
+    try:
+        task_dict, lesson = await _draft_lesson(req)
+        draft = LessonDraft.model_validate(lesson).model_dump(mode="json")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+    out_root = _new_run_root()
+    base = str(request.base_url).rstrip("/") + "/"
+
+    def _asset(kind: str, i: int, seg: dict) -> dict:
+        path = seg.get(f"{kind}_path") or ""
+        data = {"idx": i, f"{kind}_path": path, f"{kind}_url": _public_url(base, path) if path else None}
+        if kind == "diagram":
+            data["mermaid"] = seg.get("mermaid")
+        return data
+
+    async def events():
+        segs = [dict(seg) for seg in lesson.get("segments", [])]
+        yield _sse("lesson", dict(draft, artifacts_root=out_root))
+        try:
+            async for kind, i, path in a_iter_assets_for_lesson(lesson, out_root, image_concurrency=5,
+                                                                topic=task_dict.get("topic")):
+                segs[i][f"{kind}_path"] = path
+                if path or kind == "image":
+                    yield _sse(kind, _asset(kind, i, segs[i]))
+
+            # repair failed diagrams once (in parallel), then report them
+            failed = _failed_diagrams(segs)
+            if failed:
+                ddir = os.path.join(out_root, "diagrams")
+                await asyncio.gather(*[_repair_and_render(segs[i], i, ddir, lesson.get("title"), req.model)
+                                       for i in failed])
+                for i in failed:
+                    yield _sse("diagram", _asset("diagram", i, segs[i]))
+
+            done = _with_assets(dict(lesson, segments=segs), base, out_root)
+            yield b"event: done\ndata: " + done.model_dump_json().encode() + b"\n\n"
+        except Exception as e:
+            yield _sse("error", {"detail": str(e)})
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
@@ -0,0 +1,75 @@
+"""
+Content-addressed disk cache for rendered media.
+
+  <MEDIA_CACHE_DIR>/mermaid/<sha1>.png   key: normalized Mermaid code + background
+  <MEDIA_CACHE_DIR>/img/<sha1>.png       key: image model + final (enriched) prompt
+
+Hits are hard-linked (copied across filesystems) into the run directory, so a
+repeated diagram or image costs neither an mmdc launch nor a Gemini call.
+Run directories are write-once, so sharing the inode is safe.
+On by default; MEDIA_CACHE=0 disables it.
+"""
+import hashlib
+import os
+import shutil
+import threading
+
+MEDIA_CACHE_ENABLED = os.getenv("MEDIA_CACHE", "1") == "1"
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", os.path.join("artifacts", "_cache"))
+
+
+def _sha1(*parts: str) -> str:
+    return hashlib.sha1("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+def mermaid_key(code: str, background: str) -> str:
+    # indentation and blank lines don't change the diagram
+    lines = [ln.strip() for ln in code.strip().splitlines()]
+    return _sha1(background, "\n".join(ln for ln in lines if ln))
+
+
+def image_key(model: str, prompt: str) -> str:
+    return _sha1(model, " ".join(prompt.split()))
+
+
+def _path(kind: str, key: str) -> str:
+    return os.path.join(MEDIA_CACHE_DIR, kind, f"{key}.png")
+
+
+def _place(src: str, dst: str) -> None:
+    tmp = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+def fetch(kind: str, key: str, dst: str) -> bool:
+    """Materialize the cached file for `key` at dst; False on miss. Does not raise."""
+    if not MEDIA_CACHE_ENABLED:
+        return False
+    src = _path(kind, key)
+    try:
+        if os.path.getsize(src) <= 0:
+            return False
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        _place(src, dst)
+        return True
+    except OSError:
+        return False
+
+
+def store(kind: str, key: str, src: str) -> None:
+    """Remember a freshly rendered file. Does not raise."""
+    if not MEDIA_CACHE_ENABLED:
+        return
+    dst = _path(kind, key)
+    try:
+        if os.path.exists(dst):
+            return
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        _place(src, dst)
+    except OSError as e:
+        print(f"[media_cache] store {kind}/{key} failed: {e}")
+
@@ -0,0 +1,47 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+# os.write releases the GIL, so a few threads give real write concurrency
+_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="asset-writer")
+
+
+def _write_one(path: str, data: bytes) -> None:
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            n = os.write(fd, view)
+            view = view[n:]
+    finally:
+        os.close(fd)
+
+
+class BatchWriter:
+    """
+    Collect (path, bytes) pairs and write them all in one flush():
+    parent dirs are created once per distinct directory and the files are
+    written concurrently on a shared pool, so N assets cost ~one write latency.
+    """
+
+    def __init__(self):
+        self._pending: List[Tuple[str, bytes]] = []
+
+    def submit(self, path: str, data: bytes) -> None:
+        self._pending.append((path, data))
+
+    def flush(self) -> Dict[str, bool]:
+        """Write everything queued so far; returns {path: ok}. Does not raise."""
+        pending, self._pending = self._pending, []
+        for d in {os.path.dirname(p) for p, _ in pending if os.path.dirname(p)}:
+            os.makedirs(d, exist_ok=True)
+        futures = [(p, _POOL.submit(_write_one, p, data)) for p, data in pending]
+        results: Dict[str, bool] = {}
+        for p, fut in futures:
+            try:
+                fut.result()
+                results[p] = True
+            except Exception as e:
+                print(f"[writer] {p} failed: {e}")
+                results[p] = False
+        return results
@@ -1,16 +1,14 @@
-import os, sys, time
+import asyncio, base64, json, os, sys, tempfile, time
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import List, Dict, Tuple, Optional
-from google import genai
 from google.genai import types
 
-DEFAULT_IMG_MODEL = os.getenv("GEMINI_IMG_MODEL", "gemini-2.0-flash-preview-image-generation")
+from ..llm_gateway import get_client
+from . import _media_cache
+from .prompt_enricher import enrich_image_prompt
+from ._writer import BatchWriter
 
-def _client():
-    api_key = os.getenv("GEMINI_API_KEY")
-    if not api_key:
-        raise RuntimeError("GEMINI_API_KEY not set")
-    return genai.Client(api_key=api_key)
+DEFAULT_IMG_MODEL = os.getenv("GEMINI_IMG_MODEL", "gemini-2.0-flash-preview-image-generation")
 
 def _pick_inline_image(parts) -> Optional[bytes]:
     for p in parts or []:
@@ -21,7 +19,7 @@ def _pick_inline_image(parts) -> Optional[bytes]:
     return None
 
 def _gen_one_image(prompt: str, model_name: Optional[str] = None, tries: int = 2, backoff: float = 0.8) -> bytes:
-    client = _client()
+    client = get_client()
     model = model_name or DEFAULT_IMG_MODEL
 
     last_err = None
@@ -46,28 +44,209 @@ def _gen_one_image(prompt: str, model_name: Optional[str] = None, tries: int = 2
 
     raise last_err or RuntimeError("image generation failed")
 
+async def _a_gen_one_image(client, prompt: str, model_name: Optional[str] = None,
+                           tries: int = 2, backoff: float = 0.8) -> bytes:
+    model = model_name or DEFAULT_IMG_MODEL
+
+    last_err = None
+    for attempt in range(1, tries + 1):
+        try:
+            res = await client.aio.models.generate_content(
+                model=model,
+                contents=prompt,
+                config=types.GenerateContentConfig(response_modalities=["TEXT", "IMAGE"])
+            )
+            parts = res.candidates[0].content.parts if res.candidates else []
+            data = _pick_inline_image(parts)
+            if data:
+                return data
+            last_err = RuntimeError("No image data in response")
+        except Exception as e:
+            last_err = e
+
+        if attempt < tries:
+            await asyncio.sleep(backoff * attempt)
+
+    raise last_err or RuntimeError("image generation failed")
+
+def _take_cached(prompts: List[Tuple[int, str]], out_dir: str, model_name: Optional[str],
+                 saved: Dict[int, str], topic: Optional[str] = None) -> Dict[int, Tuple[str, str]]:
+    """
+    Enrich each prompt for `topic`, link cache hits into out_dir (recorded in saved)
+    and return {idx: (enriched prompt, cache key)} still to generate.
+    """
+    model = model_name or DEFAULT_IMG_MODEL
+    todo: Dict[int, Tuple[str, str]] = {}
+    for idx, raw in prompts:
+        prompt = enrich_image_prompt(raw, topic=topic)
+        key = _media_cache.image_key(model, prompt)
+        path = os.path.join(out_dir, f"img_{idx}.png")
+        if _media_cache.fetch("img", key, path):
+            saved[idx] = path
+        else:
+            todo[idx] = (prompt, key)
+    return todo
+
+def _write_saved(writer: BatchWriter, saved: Dict[int, str],
+                 todo: Optional[Dict[int, Tuple[str, str]]] = None) -> Dict[int, str]:
+    # write all PNGs in one concurrent batch
+    written = writer.flush()
+    for idx, path in saved.items():
+        if not path or path not in written:   # failed, or linked from the cache
+            continue
+        if not written[path]:
+            saved[idx] = ""
+        elif todo and idx in todo:
+            _media_cache.store("img", todo[idx][1], path)
+    return saved
+
+
 def gen_images(
     prompts: List[Tuple[int, str]],
     out_dir: str,
     concurrency: int = 5,
-    model_name: Optional[str] = None
+    model_name: Optional[str] = None,
+    topic: Optional[str] = None
 ) -> Dict[int, str]:
+    """Generate img_{idx}.png per (idx, prompt); prompts are enriched for `topic` (no-op if already enriched)."""
     os.makedirs(out_dir, exist_ok=True)
     saved: Dict[int, str] = {}
     concurrency = max(1, min(concurrency, 32))
 
-    from concurrent.futures import ThreadPoolExecutor, as_completed
+    todo = _take_cached(prompts, out_dir, model_name, saved, topic)
+    writer = BatchWriter()
     with ThreadPoolExecutor(max_workers=concurrency) as ex:
-        futures = {ex.submit(_gen_one_image, prompt, model_name): idx for (idx, prompt) in prompts}
+        futures = {ex.submit(_gen_one_image, prompt, model_name): idx for idx, (prompt, _) in todo.items()}
         for fut in as_completed(futures):
             idx = futures[fut]
             try:
                 img_bytes = fut.result()
                 path = os.path.join(out_dir, f"img_{idx}.png")
-                with open(path, "wb") as f:
-                    f.write(img_bytes)
+                writer.submit(path, img_bytes)
                 saved[idx] = path
             except Exception as e:
                 print(f"[image_gen] idx={idx} failed: {e}", file=sys.stderr)
                 saved[idx] = ""
-    return saved
+
+    return _write_saved(writer, saved, todo)
+
+
+async def a_gen_images(
+    prompts: List[Tuple[int, str]],
+    out_dir: str,
+    concurrency: int = 5,
+    model_name: Optional[str] = None,
+    topic: Optional[str] = None
+) -> Dict[int, str]:
+    """Async twin of gen_images: one client, all requests in flight on the event loop (capped by concurrency)."""
+    os.makedirs(out_dir, exist_ok=True)
+    saved: Dict[int, str] = {}
+    sem = asyncio.Semaphore(max(1, min(concurrency, 32)))
+    todo = await asyncio.to_thread(_take_cached, prompts, out_dir, model_name, saved, topic)
+    if not todo:
+        return saved
+    client = get_client()
+    writer = BatchWriter()
+
+    async def _one(idx: int, prompt: str):
+        async with sem:
+            try:
+                img_bytes = await _a_gen_one_image(client, prompt, model_name)
+            except Exception as e:
+                print(f"[image_gen] idx={idx} failed: {e}", file=sys.stderr)
+                saved[idx] = ""
+                return
+        path = os.path.join(out_dir, f"img_{idx}.png")
+        writer.submit(path, img_bytes)
+        saved[idx] = path
+
+    await asyncio.gather(*[_one(idx, prompt) for idx, (prompt, _) in todo.items()])
+    return await asyncio.to_thread(_write_saved, writer, saved, todo)
+
+
+# ---------- Batch API (offline / bulk: 50% cost, results within 24h) ----------
+
+_BATCH_DONE = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+
+def _batch_line(idx: int, prompt: str) -> str:
+    return json.dumps({
+        "key": f"img_{idx}",
+        "request": {
+            "contents": [{"parts": [{"text": prompt}]}],
+            "generation_config": {"response_modalities": ["TEXT", "IMAGE"]},
+        },
+    }, ensure_ascii=False)
+
+def _batch_image(response: dict) -> Optional[bytes]:
+    for cand in response.get("candidates") or []:
+        for part in (cand.get("content") or {}).get("parts") or []:
+            inline = part.get("inlineData") or part.get("inline_data") or {}
+            if inline.get("data"):
+                return base64.b64decode(inline["data"])
+    return None
+
+def gen_images_batch(
+    prompts: List[Tuple[int, str]],
+    out_dir: str,
+    model_name: Optional[str] = None,
+    poll_s: float = 30.0,
+    timeout_s: float = 24 * 3600,
+    topic: Optional[str] = None,
+) -> Dict[int, str]:
+    """
+    Generate all prompts as one Gemini Batch API job: upload a JSONL of requests,
+    poll until the job finishes, then write img_{idx}.png from the result file.
+    Far cheaper than gen_images but not interactive; same return shape
+    ({idx: path or ""}). Does not raise on per-image failures.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    saved: Dict[int, str] = {idx: "" for idx, _ in prompts}
+    todo = _take_cached(prompts, out_dir, model_name, saved, topic)
+    if not todo:
+        return saved
+    client = get_client()
+
+    with tempfile.NamedTemporaryFile("w", suffix=".jsonl", delete=False, encoding="utf-8") as tf:
+        tf.write("\n".join(_batch_line(idx, prompt) for idx, (prompt, _) in todo.items()) + "\n")
+        src_path = tf.name
+    try:
+        src = client.files.upload(file=src_path, config=types.UploadFileConfig(
+            display_name=f"img-batch-{int(time.time())}", mime_type="jsonl"))
+    finally:
+        try:
+            os.remove(src_path)
+        except Exception:
+            pass
+
+    job = client.batches.create(model=model_name or DEFAULT_IMG_MODEL, src=src.name)
+    deadline = time.time() + timeout_s
+    while job.state.name not in _BATCH_DONE:
+        if time.time() > deadline:
+            print(f"[image_batch] {job.name} still {job.state.name} after {timeout_s:.0f}s", file=sys.stderr)
+            return saved
+        time.sleep(poll_s)
+        job = client.batches.get(name=job.name)
+    if job.state.name != "JOB_STATE_SUCCEEDED":
+        print(f"[image_batch] {job.name} ended in {job.state.name}: {getattr(job, 'error', None)}", file=sys.stderr)
+        return saved
+
+    raw = client.files.download(file=job.dest.file_name)
+    writer = BatchWriter()
+    for line in raw.decode("utf-8").splitlines():
+        if not line.strip():
+            continue
+        row = json.loads(line)
+        key = str(row.get("key", ""))
+        if not key.startswith("img_"):
+            continue
+        idx = int(key[4:])
+        if idx not in todo:
+            continue
+        data = _batch_image(row.get("response") or {})
+        if data is None:
+            print(f"[image_batch] idx={idx} failed: {row.get('error') or 'no image data'}", file=sys.stderr)
+            continue
+        path = os.path.join(out_dir, f"img_{idx}.png")
+        writer.submit(path, data)
+        saved[idx] = path
+    return _write_saved(writer, saved, todo)
@@ -1,52 +1,329 @@
+import asyncio
+import atexit
 import os
+import queue
+import shutil
 import subprocess
 import tempfile
-from typing import Optional
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from functools import lru_cache
+from typing import List, Optional
 
-# Resolve Mermaid CLI path:
+from . import _media_cache
+
+# Browser renderer: one long-lived headless Chromium (Playwright) that renders with
+# mermaid.js, instead of paying mmdc's Node + Chromium cold start per diagram.
+# MERMAID_RENDERER=mmdc forces the CLI; without playwright installed the CLI is used anyway.
+MERMAID_RENDERER = os.getenv("MERMAID_RENDERER", "auto").lower()
+MERMAID_JS = os.getenv("MERMAID_JS", "https://cdn.jsdelivr.net/npm/mermaid@10/dist/mermaid.min.js")
+MERMAID_RENDER_TIMEOUT_S = float(os.getenv("MERMAID_RENDER_TIMEOUT", "30"))
+# a renderer that timed out is replaced at most this many times before we settle on mmdc
+_MAX_RENDERER_RESTARTS = 3
+_TIMEOUTS = (TimeoutError, FutureTimeout, asyncio.TimeoutError)
+
+# Resolve Mermaid CLI path (once per process):
 # - use MERMAID_BIN if provided (Windows users often set mmdc.cmd)
-# - otherwise try "mmdc" (must be on PATH)
+# - otherwise the absolute path of "mmdc" on PATH (shutil.which honours PATHEXT, so mmdc.cmd on Windows)
+# The argv list is always run without a shell; an absolute path spares the per-call PATH lookup.
+@lru_cache(maxsize=1)
 def _resolve_mermaid_bin() -> str:
     env_bin = os.getenv("MERMAID_BIN")
     if env_bin and os.path.exists(env_bin):
-        return env_bin
+        return os.path.abspath(env_bin)
     # fallbacks
-    return "mmdc"  # works if mermaid-cli is on PATH
+    return shutil.which("mmdc") or "mmdc"
 
-def render_mermaid(mermaid_code: str, out_png_path: str, background: str = "transparent") -> bool:
+def _write_temp_mmd(mermaid_code: str) -> str:
+    with tempfile.NamedTemporaryFile("w", suffix=".mmd", delete=False, encoding="utf-8") as tf:
+        tf.write(mermaid_code)
+        return tf.name
+
+def _background(background: str) -> str:
+    return background or os.getenv("MERMAID_BG", "#ffe45e")  # light yellow
+
+def _mmdc_cmd(tmp_in: str, out_png_path: str, background: str) -> List[str]:
+    return [
+        _resolve_mermaid_bin(),
+        "-i", tmp_in,
+        "-o", out_png_path,
+        "--backgroundColor", _background(background),
+        "--theme", "neutral"
+    ]
+
+def _check_output(rc: int, out_png_path: str, stderr: str, stdout: str) -> bool:
+    ok = rc == 0 and os.path.exists(out_png_path) and os.path.getsize(out_png_path) > 0
+    if not ok:
+        # helpful for logs; FastAPI will still handle repair steps if you implemented them
+        print(f"[mermaid] render failed rc={rc}\nSTDERR:\n{stderr}\nSTDOUT:\n{stdout}")
+    return ok
+
+def _remove_quietly(path: str) -> None:
+    try:
+        os.remove(path)
+    except Exception:
+        pass
+
+class RendererUnavailable(RuntimeError):
+    """The browser could not be started; callers should fall back to mmdc."""
+
+
+_RENDER_JS = """
+async ([code, bg, ms]) => {
+  const id = "d" + (++window.__n);
+  const box = document.getElementById("c");
+  document.body.style.background = bg;
+  try {
+    const { svg } = await Promise.race([
+      mermaid.render(id, code),
+      new Promise((_, reject) => setTimeout(() => reject(new Error(`mermaid.render timed out after ${ms} ms`)), ms)),
+    ]);
+    box.innerHTML = svg;
+  } finally {
+    // mermaid leaves its scratch/error node behind when parsing fails
+    document.getElementById(id)?.remove();
+    document.getElementById("d" + id)?.remove();
+  }
+}
+"""
+
+
+class MermaidRenderer:
     """
-    Render a Mermaid diagram to PNG using the Mermaid CLI (mmdc).
-    Returns True on success, False on failure. Does not raise.
+    Headless Chromium page with mermaid.js loaded, owned by a dedicated thread
+    (Playwright's sync API is bound to the thread that started it). Callers
+    enqueue (code, background) and get a Future with the PNG bytes; renders
+    are serialized on the one warm page, ~100 ms each instead of seconds.
+    Every page call is bounded by MERMAID_RENDER_TIMEOUT; a caller that still
+    times out abandon()s the renderer so queued work moves to mmdc and
+    _renderer() starts a fresh browser.
     """
-    try:
-        os.makedirs(os.path.dirname(out_png_path), exist_ok=True)
-        # write a temp .mmd file
-        with tempfile.NamedTemporaryFile("w", suffix=".mmd", delete=False, encoding="utf-8") as tf:
-            tf.write(mermaid_code)
-            tmp_in = tf.name
-
-        bg = background or os.getenv("MERMAID_BG", "#ffe45e")  # light yellow
-        cmd = [
-            _resolve_mermaid_bin(),
-            "-i", tmp_in,
-            "-o", out_png_path,
-            "--backgroundColor", bg,
-            "--theme", "neutral"
-        ]
 
+    def __init__(self, js_src: str = MERMAID_JS):
+        self._js_src = js_src
+        self._jobs: "queue.Queue" = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.failed = False
+        self.wedged = False
+
+    def submit(self, code: str, background: str = "transparent") -> Future:
+        fut: Future = Future()
+        if self.failed:
+            fut.set_exception(RendererUnavailable("browser renderer failed to start"))
+            return fut
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="mermaid-renderer", daemon=True)
+                self._thread.start()
+        self._jobs.put((code, _background(background), fut))
+        if self.failed:
+            # the thread gave up between the check above and the put
+            self._fail_pending(RendererUnavailable("browser renderer failed to start"))
+        return fut
+
+    def render(self, code: str, background: str = "transparent") -> bytes:
+        return self.submit(code, background).result(timeout=MERMAID_RENDER_TIMEOUT_S)
+
+    def abandon(self, reason: str) -> None:
+        """Stop using this renderer (a render hung); the thread exits once its current call returns."""
+        if not self.wedged:
+            print(f"[mermaid] browser renderer abandoned: {reason}")
+        self.wedged = True
+        self.failed = True
+        self._fail_pending(RendererUnavailable(reason))
+
+    def close(self) -> None:
+        self._jobs.put(None)
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def _start_page(self, pw):
+        browser = pw.chromium.launch()
+        page = browser.new_page()
+        page.set_default_timeout(MERMAID_RENDER_TIMEOUT_S * 1000)
+        page.set_content('<html><body style="margin:0"><div id="c" style="display:inline-block"></div></body></html>')
+        if os.path.exists(self._js_src):
+            page.add_script_tag(path=self._js_src)
+        else:
+            page.add_script_tag(url=self._js_src)
+        page.evaluate("() => { window.__n = 0; mermaid.initialize({ startOnLoad: false, theme: 'neutral' }); }")
+        return browser, page
+
+    def _fail_pending(self, err: Exception) -> None:
+        while True:
+            try:
+                job = self._jobs.get_nowait()
+            except queue.Empty:
+                return
+            # skip futures whose caller already gave up (timed out / cancelled)
+            if job is not None and job[2].set_running_or_notify_cancel():
+                job[2].set_exception(err)
+
+    def _run(self) -> None:
+        try:
+            from playwright.sync_api import sync_playwright
+            pw = sync_playwright().start()
+            browser, page = self._start_page(pw)
+        except Exception as e:
+            print(f"[mermaid] browser renderer unavailable, using mmdc: {e}")
+            self.failed = True
+            self._fail_pending(RendererUnavailable(str(e)))
+            return
+        try:
+            while not self.failed:
+                job = self._jobs.get()
+                if job is None:
+                    break
+                code, bg, fut = job
+                if not fut.set_running_or_notify_cancel():
+                    continue
+                try:
+                    page.evaluate(_RENDER_JS, [code, bg, MERMAID_RENDER_TIMEOUT_S * 1000])
+                    fut.set_result(page.locator("#c > svg").screenshot(omit_background=(bg == "transparent")))
+                except Exception as e:
+                    fut.set_exception(e)
+        finally:
+            self.failed = True
+            self._fail_pending(RendererUnavailable("browser renderer stopped"))
+            try:
+                browser.close()
+                pw.stop()
+            except Exception:
+                pass
+
+
+_RENDERER: Optional[MermaidRenderer] = None
+_RENDERER_LOCK = threading.Lock()
+_RENDERER_RESTARTS = 0
+
+def _renderer() -> Optional[MermaidRenderer]:
+    """Process-wide browser renderer, or None when disabled / playwright missing / it failed to start."""
+    global _RENDERER, _RENDERER_RESTARTS
+    if MERMAID_RENDERER == "mmdc":
+        return None
+    if _RENDERER is None or (_RENDERER.wedged and _RENDERER_RESTARTS < _MAX_RENDERER_RESTARTS):
+        with _RENDERER_LOCK:
+            if _RENDERER is None or (_RENDERER.wedged and _RENDERER_RESTARTS < _MAX_RENDERER_RESTARTS):
+                try:
+                    import playwright.sync_api  # noqa: F401
+                except ImportError:
+                    return None
+                if _RENDERER is not None:
+                    _RENDERER_RESTARTS += 1
+                _RENDERER = MermaidRenderer()
+                atexit.register(_RENDERER.close)
+    return None if _RENDERER.failed else _RENDERER
+
+def _save_png(data: bytes, out_png_path: str) -> bool:
+    if not data:
+        return False
+    with open(out_png_path, "wb") as f:
+        f.write(data)
+    return True
+
+
+def _render_mmdc(mermaid_code: str, out_png_path: str, background: str) -> bool:
+    tmp_in = _write_temp_mmd(mermaid_code)
+    try:
         # Run and capture output; don’t raise on non-zero to allow repair fallback upstream
-        proc = subprocess.run(cmd, capture_output=True, text=True, check=False)
-        ok = proc.returncode == 0 and os.path.exists(out_png_path) and os.path.getsize(out_png_path) > 0
+        proc = subprocess.run(_mmdc_cmd(tmp_in, out_png_path, background),
+                              capture_output=True, text=True, check=False)
+        return _check_output(proc.returncode, out_png_path, proc.stderr, proc.stdout)
+    finally:
+        _remove_quietly(tmp_in)
+
+_ASYNC_SUBPROCESS = True
+
+async def _a_render_mmdc(mermaid_code: str, out_png_path: str, background: str) -> bool:
+    global _ASYNC_SUBPROCESS
+    if not _ASYNC_SUBPROCESS:
+        return await asyncio.to_thread(_render_mmdc, mermaid_code, out_png_path, background)
+    tmp_in = await asyncio.to_thread(_write_temp_mmd, mermaid_code)
+    try:
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *_mmdc_cmd(tmp_in, out_png_path, background),
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            )
+        except NotImplementedError:
+            # SelectorEventLoop on Windows (e.g. uvicorn --reload) can't spawn subprocesses
+            print("[mermaid] event loop has no subprocess support; running mmdc on threads")
+            _ASYNC_SUBPROCESS = False
+            return await asyncio.to_thread(_render_mmdc, mermaid_code, out_png_path, background)
+        out, err = await proc.communicate()
+        return await asyncio.to_thread(_check_output, proc.returncode, out_png_path,
+                                       err.decode("utf-8", "replace"), out.decode("utf-8", "replace"))
+    finally:
+        await asyncio.to_thread(_remove_quietly, tmp_in)
 
-        if not ok:
-            # helpful for logs; FastAPI will still handle repair steps if you implemented them
-            print(f"[mermaid] render failed rc={proc.returncode}\nSTDERR:\n{proc.stderr}\nSTDOUT:\n{proc.stdout}")
 
+def _render_fresh(mermaid_code: str, out_png_path: str, background: str) -> bool:
+    r = _renderer()
+    if r is not None:
         try:
-            os.remove(tmp_in)
-        except Exception:
+            return _save_png(r.render(mermaid_code, background), out_png_path)
+        except RendererUnavailable:
             pass
+        except _TIMEOUTS:
+            r.abandon(f"render exceeded {MERMAID_RENDER_TIMEOUT_S:g}s")
+        except Exception as e:
+            print(f"[mermaid] render failed: {e}")
+            return False
+    return _render_mmdc(mermaid_code, out_png_path, background)
+
+async def _a_render_fresh(mermaid_code: str, out_png_path: str, background: str) -> bool:
+    r = _renderer()
+    if r is not None:
+        try:
+            data = await asyncio.wait_for(asyncio.wrap_future(r.submit(mermaid_code, background)),
+                                          MERMAID_RENDER_TIMEOUT_S)
+            return await asyncio.to_thread(_save_png, data, out_png_path)
+        except RendererUnavailable:
+            pass
+        except _TIMEOUTS:
+            r.abandon(f"render exceeded {MERMAID_RENDER_TIMEOUT_S:g}s")
+        except Exception as e:
+            print(f"[mermaid] render failed: {e}")
+            return False
+    return await _a_render_mmdc(mermaid_code, out_png_path, background)
+
+
+def _fetch_cached(key: str, out_png_path: str) -> bool:
+    os.makedirs(os.path.dirname(out_png_path), exist_ok=True)
+    return _media_cache.fetch("mermaid", key, out_png_path)
 
+def render_mermaid(mermaid_code: str, out_png_path: str, background: str = "transparent") -> bool:
+    """
+    Render a Mermaid diagram to PNG: content-hash cache first, then the warm
+    browser renderer when available, otherwise the Mermaid CLI (mmdc).
+    Returns True on success, False on failure. Does not raise.
+    """
+    try:
+        key = _media_cache.mermaid_key(mermaid_code, _background(background))
+        if _fetch_cached(key, out_png_path):
+            return True
+        ok = _render_fresh(mermaid_code, out_png_path, background)
+        if ok:
+            _media_cache.store("mermaid", key, out_png_path)
+        return ok
+    except Exception as e:
+        print(f"[mermaid] exception: {e}")
+        return False
+
+async def a_render_mermaid(mermaid_code: str, out_png_path: str, background: str = "transparent") -> bool:
+    """
+    Async twin of render_mermaid: awaits the browser renderer's future, or runs
+    mmdc via asyncio.create_subprocess_exec, and does its file I/O (cache link/copy,
+    temp .mmd) on worker threads, so the event loop stays free. Does not raise.
+    """
+    try:
+        key = _media_cache.mermaid_key(mermaid_code, _background(background))
+        if await asyncio.to_thread(_fetch_cached, key, out_png_path):
+            return True
+        ok = await _a_render_fresh(mermaid_code, out_png_path, background)
+        if ok:
+            await asyncio.to_thread(_media_cache.store, "mermaid", key, out_png_path)
         return ok
     except Exception as e:
         print(f"[mermaid] exception: {e}")
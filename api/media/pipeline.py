@@ -1,44 +1,144 @@
+import asyncio
 import os
-from typing import Dict, Any, List
-from .mermaid import render_mermaid
-from .images import gen_images
-from .prompt_enricher import enrich_image_prompt
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+from .mermaid import render_mermaid, a_render_mermaid
+from .images import gen_images, a_gen_images
 
-def render_assets_for_lesson(lesson: Dict[str, Any], out_root: str, image_concurrency: int = 5) -> Dict[str, Any]:
+# every mmdc run starts its own headless Chromium, so keep the fan-out modest
+MERMAID_CONCURRENCY = int(os.getenv("MERMAID_CONCURRENCY", "4"))
+
+# Shared across requests. Threads, not processes: each render is an mmdc child
+# process (or a job on the browser renderer's thread), so the workers only wait
+# and release the GIL; a process pool would add pickling and its own startup.
+_RENDER_POOL: Optional[ThreadPoolExecutor] = None
+_RENDER_POOL_LOCK = threading.Lock()
+
+def _render_pool() -> ThreadPoolExecutor:
+    global _RENDER_POOL
+    if _RENDER_POOL is None:
+        with _RENDER_POOL_LOCK:
+            if _RENDER_POOL is None:
+                _RENDER_POOL = ThreadPoolExecutor(max_workers=max(1, MERMAID_CONCURRENCY),
+                                                  thread_name_prefix="mermaid-render")
+    return _RENDER_POOL
+
+def _make_dirs(out_root: str) -> Tuple[str, str]:
+    diag_dir = os.path.join(out_root, "diagrams")
+    img_dir  = os.path.join(out_root, "images")
+    os.makedirs(diag_dir, exist_ok=True)
+    os.makedirs(img_dir, exist_ok=True)
+    return diag_dir, img_dir
+
+def _image_prompts(segs: List[Dict[str, Any]]) -> List[Tuple[int, str]]:
+    return [(i, seg["image_prompt"].strip()) for i, seg in enumerate(segs)
+            if isinstance(seg.get("image_prompt"), str) and seg["image_prompt"].strip()]
+
+def _apply_images(segs: List[Dict[str, Any]], saved: Dict[int, str]) -> None:
+    for i, path in saved.items():
+        if 0 <= i < len(segs):
+            segs[i]["image_path"] = path
+
+def render_assets_for_lesson(lesson: Dict[str, Any], out_root: str, image_concurrency: int = 5,
+                             topic: Optional[str] = None) -> Dict[str, Any]:
     """
     Enrich a LessonDraft-like dict by rendering Mermaid diagrams and generating images.
-    - Diagrams: diagram_{i}.png (serial)
+    - Diagrams: diagram_{i}.png (parallel, shared pool of MERMAID_CONCURRENCY)
     - Images:   img_{i}.png (parallel, capped by image_concurrency)
+    Image prompts are enriched for `topic` (the TaskSpec topic; falls back to the lesson title).
     Returns the same dict with segments[i].diagram_path / image_path added.
     """
     segs: List[Dict[str, Any]] = list(lesson.get("segments", []))
-    os.makedirs(out_root, exist_ok=True)
-    diag_dir = os.path.join(out_root, "diagrams")
-    img_dir  = os.path.join(out_root, "images")
-    os.makedirs(diag_dir, exist_ok=True)
-    os.makedirs(img_dir, exist_ok=True)
+    diag_dir, img_dir = _make_dirs(out_root)
 
     # 1) Mermaid → PNG
-    for i, seg in enumerate(segs):
-        mmd = seg.get("mermaid")
-        if isinstance(mmd, str) and mmd.strip():
-            out_path = os.path.join(diag_dir, f"diagram_{i}.png")
-            ok = render_mermaid(mmd, out_path)
-            seg["diagram_path"] = out_path if ok else ""
+    jobs = [(i, seg["mermaid"], os.path.join(diag_dir, f"diagram_{i}.png")) for i, seg in enumerate(segs)
+            if isinstance(seg.get("mermaid"), str) and seg["mermaid"].strip()]
+    oks = _render_pool().map(lambda job: render_mermaid(job[1], job[2]), jobs)
+    for (i, _, out_path), ok in zip(jobs, oks):
+        segs[i]["diagram_path"] = out_path if ok else ""
 
     # 2) Image prompts → PNG (parallel)
-    prompts = []
-    for i, seg in enumerate(segs):
-        p = seg.get("image_prompt")
-        if isinstance(p, str) and p.strip():
-            enriched = enrich_image_prompt(p.strip(), topic=lesson.get("title"))
-            prompts.append((i, enriched))
-
+    prompts = _image_prompts(segs)
     if prompts:
-        saved = gen_images(prompts, out_dir=img_dir, concurrency=image_concurrency)
-        for i, path in saved.items():
-            if 0 <= i < len(segs):
-                segs[i]["image_path"] = path
+        _apply_images(segs, gen_images(prompts, out_dir=img_dir, concurrency=image_concurrency,
+                                       topic=topic or lesson.get("title")))
+
+    out = dict(lesson)
+    out["segments"] = segs
+    return out
+
+
+async def a_iter_assets_for_lesson(lesson: Dict[str, Any], out_root: str, image_concurrency: int = 5,
+                                   diagram_concurrency: int = MERMAID_CONCURRENCY,
+                                   topic: Optional[str] = None) -> AsyncIterator[Tuple[str, int, str]]:
+    """
+    Render every diagram and image of the lesson concurrently and yield
+    ("diagram" | "image", segment index, path or "" on failure) as each one finishes.
+    Does not modify `lesson`. Closing the iterator early cancels the outstanding work.
+    Each image is its own a_gen_images call so it can be reported as soon as it is
+    written; a_render_assets_for_lesson keeps the single batched call.
+    """
+    segs: List[Dict[str, Any]] = list(lesson.get("segments", []))
+    diag_dir, img_dir = _make_dirs(out_root)
+    dsem = asyncio.Semaphore(max(1, diagram_concurrency))
+    isem = asyncio.Semaphore(max(1, image_concurrency))
+    topic = topic or lesson.get("title")
+
+    async def _diagram(i: int, mmd: str):
+        out_path = os.path.join(diag_dir, f"diagram_{i}.png")
+        async with dsem:
+            ok = await a_render_mermaid(mmd, out_path)
+        return "diagram", i, out_path if ok else ""
+
+    async def _image(i: int, prompt: str):
+        async with isem:
+            saved = await a_gen_images([(i, prompt)], out_dir=img_dir, concurrency=1, topic=topic)
+        return "image", i, saved.get(i, "")
+
+    tasks = [asyncio.ensure_future(_diagram(i, seg["mermaid"])) for i, seg in enumerate(segs)
+             if isinstance(seg.get("mermaid"), str) and seg["mermaid"].strip()]
+    tasks += [asyncio.ensure_future(_image(i, p)) for i, p in _image_prompts(segs)]
+    try:
+        for fut in asyncio.as_completed(tasks):
+            yield await fut
+    finally:
+        for t in tasks:
+            t.cancel()
+
+
+async def a_render_assets_for_lesson(lesson: Dict[str, Any], out_root: str, image_concurrency: int = 5,
+                                     diagram_concurrency: int = MERMAID_CONCURRENCY,
+                                     topic: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Async variant of render_assets_for_lesson: every Mermaid render is its own
+    mmdc subprocess (at most diagram_concurrency at once) and they run alongside
+    image generation instead of before it.
+    """
+    segs: List[Dict[str, Any]] = list(lesson.get("segments", []))
+    diag_dir, img_dir = _make_dirs(out_root)
+    sem = asyncio.Semaphore(max(1, diagram_concurrency))
+
+    async def _diagram(i: int, mmd: str):
+        out_path = os.path.join(diag_dir, f"diagram_{i}.png")
+        async with sem:
+            ok = await a_render_mermaid(mmd, out_path)
+        segs[i]["diagram_path"] = out_path if ok else ""
+
+    jobs = [_diagram(i, seg["mermaid"]) for i, seg in enumerate(segs)
+            if isinstance(seg.get("mermaid"), str) and seg["mermaid"].strip()]
+
+    # one batched call: one cache pass and one writer flush for all images
+    prompts = _image_prompts(segs)
+    images = (a_gen_images(prompts, out_dir=img_dir, concurrency=image_concurrency, topic=topic or lesson.get("title"))
+              if prompts else None)
+    if images is not None:
+        jobs.append(images)
+
+    results = await asyncio.gather(*jobs)
+    if images is not None:
+        _apply_images(segs, results[-1])
 
     out = dict(lesson)
     out["segments"] = segs
@@ -1,22 +1,45 @@
 # api/media/prompt_enricher.py
+import re
+from functools import lru_cache
 from typing import Optional
 
+_MARKER = "Create a clean 2D vector schematic"
+
+# topic-specific guidance is only sent when it applies; it is pure token cost otherwise
+_BFS_RE = re.compile(r"\b(bfs|breadth[- ]first)\b", re.IGNORECASE)
+_GRAPH_RE = re.compile(r"\b(graphs?|trees?|nodes?|vertex|vertices|edges?|bfs|dfs|breadth[- ]first|depth[- ]first"
+                       r"|dijkstra|traversal|shortest path)\b", re.IGNORECASE)
+_BFS_LINE = "If relevant, show BFS levels as concentric ‘rings’ or colored layers (L0=source, L1, L2...). "
+_GRAPH_LINE = ("Ensure nodes are distinct circles with consistent spacing; "
+               "label nodes A, B, C, D... starting at the source. ")
+_STYLE_END = "Avoid people, faces, hands, and extraneous scenery."
+
+@lru_cache(maxsize=256)
+def _style_head(topic: Optional[str]) -> str:
+    # depends only on the topic, so it is built once per lesson, not once per prompt
+    topic_hint = f" about {topic}" if topic else ""
+    return (
+        f"{_MARKER}{topic_hint}. "
+        "Primary goal: accurately illustrate the concept, not a photo. "
+        "Style: flat, minimal, high-contrast, no textures, no drop shadows, no photorealism. "
+        "Use a white background, thin black outlines, and a limited accent palette. "
+        "Include clear labels and arrows. "
+        "Avoid text paragraphs inside the image; use concise labels only. "
+        "Render at 1024x1024. "
+    )
+
+def _style_tail(text: str) -> str:
+    return ((_BFS_LINE if _BFS_RE.search(text) else "")
+            + (_GRAPH_LINE if _GRAPH_RE.search(text) else "")
+            + _STYLE_END)
+
+@lru_cache(maxsize=1024)
 def enrich_image_prompt(raw: str, topic: Optional[str] = None) -> str:
     """
     Expand terse prompts into schematic, labeled, unambiguous prompts.
-    Tuned for CS/algorithms educational imagery.
+    Tuned for CS/algorithms educational imagery. Already-enriched prompts are returned as is.
     """
-    topic_hint = f" about {topic}" if topic else ""
-    return (
-        f"Create a clean 2D vector schematic{topic_hint}. "
-        f"Primary goal: accurately illustrate the concept, not a photo. "
-        f"Style: flat, minimal, high-contrast, no textures, no drop shadows, no photorealism. "
-        f"Use a white background, thin black outlines, and a limited accent palette. "
-        f"Include clear labels and arrows. "
-        f"Avoid text paragraphs inside the image; use concise labels only. "
-        f"Render at 1024x1024. "
-        f"Content: {raw} "
-        f"If relevant, show BFS levels as concentric ‘rings’ or colored layers (L0=source, L1, L2...). "
-        f"Ensure nodes are distinct circles with consistent spacing; label nodes A, B, C, D... starting at the source. "
-        f"Avoid people, faces, hands, and extraneous scenery."
-    )
+    if raw.startswith(_MARKER):
+        return raw
+    tail = _style_tail(f"{topic or ''} {raw}")
+    return f"{_style_head(topic)}Content: {raw} {tail}"
@@ -5,10 +5,12 @@ from pydantic import BaseModel, Field
 OutputKind = Literal["text", "diagram", "image", "audio", "video"]
 TextDepth = Literal["brief", "detailed", "very_detailed"]
 SegmentKind = Literal["content", "diagram", "image"]
+ServiceTier = Literal["standard", "flex", "priority"]   # Gemini inference tier; None → API default
 
 class NormalizeRequest(BaseModel):
     chat: str
     defaults: Optional[Dict[str, Any]] = Field(default_factory=dict)
+    service_tier: Optional[ServiceTier] = None
 
 class TaskSpec(BaseModel):
     topic: str
@@ -46,6 +48,7 @@ class GenerateRequest(BaseModel):
     task_spec: TaskSpec
     helpful_notes: List[str] = Field(default_factory=list)
     model: Optional[str] = None
+    service_tier: Optional[ServiceTier] = None
 
 # ---- Lesson models (draft JSON) ----
 class LessonSegment(BaseModel):
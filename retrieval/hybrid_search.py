@@ -1,10 +1,13 @@
 from typing import List, Dict, Any, Tuple
+from functools import lru_cache
+import threading
+import time
 import numpy as np
 
 from whoosh import index
 from whoosh.qparser import MultifieldParser
 
-from qdrant_client import QdrantClient
+from qdrant_client import QdrantClient, models
 from sentence_transformers import SentenceTransformer
 
 from .mmr import mmr_select
@@ -15,60 +18,129 @@ QDRANT_HOST = "localhost"
 QDRANT_PORT = 6333
 QDRANT_COLLECTION = "books_corpus"
 EMB_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
-
-def _normalize_scores(vals: List[float]) -> List[float]:
-    if not vals:
-        return []
-    vmin, vmax = float(np.min(vals)), float(np.max(vals))
+SEARCH_CACHE_TTL_S = 600
+QUERY_DEDUP_COS = 0.95   # queries this similar to an earlier one are not searched again
+
+# Loaded once per process: the model load and the Qdrant connection used to be
+# paid on every hybrid_search call.
+_SINGLETONS: Dict[str, Any] = {}
+_SINGLETONS_LOCK = threading.Lock()
+
+def _singleton(name: str, factory):
+    obj = _SINGLETONS.get(name)
+    if obj is None:
+        with _SINGLETONS_LOCK:
+            obj = _SINGLETONS.get(name)
+            if obj is None:
+                obj = _SINGLETONS[name] = factory()
+    return obj
+
+def get_embedder() -> SentenceTransformer:
+    return _singleton("embedder", lambda: SentenceTransformer(EMB_MODEL))
+
+def get_qdrant() -> QdrantClient:
+    return _singleton("qdrant", lambda: QdrantClient(host=QDRANT_HOST, port=QDRANT_PORT))
+
+def _whoosh_index():
+    # searcher() re-reads the TOC, so a cached Index still sees a rebuilt index
+    return _singleton("whoosh", lambda: index.open_dir(WHOOSH_INDEX_DIR))
+
+@lru_cache(maxsize=2)
+def _cross_encoder(name: str):
+    from sentence_transformers import CrossEncoder
+    return CrossEncoder(name)
+
+def _normalize_scores(vals: np.ndarray) -> np.ndarray:
+    vals = np.asarray(vals, dtype=np.float64)
+    if not vals.size:
+        return vals
+    vmin, vmax = vals.min(), vals.max()
     if vmax <= vmin + 1e-12:
-        return [0.5 for _ in vals]
-    return [float((v - vmin) / (vmax - vmin)) for v in vals]
+        return np.full(vals.shape, 0.5)
+    return (vals - vmin) / (vmax - vmin)
 
-def bm25_topk(query: str, k: int = 30) -> List[Tuple[str, float, Dict[str, Any]]]:
-    ix = index.open_dir(WHOOSH_INDEX_DIR)
+def dedupe_queries(queries: List[str]) -> List[str]:
+    """Strip / collapse whitespace and drop case-insensitive repeats, keeping the first spelling."""
+    seen, out = set(), []
+    for q in queries:
+        q = " ".join((q or "").split())
+        k = q.casefold()
+        if k and k not in seen:
+            seen.add(k)
+            out.append(q)
+    return out
+
+def _distinct_rows(vecs: np.ndarray, threshold: float) -> List[int]:
+    """Greedy: keep a row unless its cosine to an already kept row exceeds threshold (rows normalized)."""
+    keep: List[int] = []
+    for i in range(len(vecs)):
+        if not keep or float(np.max(vecs[keep] @ vecs[i])) <= threshold:
+            keep.append(i)
+    return keep
+
+def bm25_topk_batch(queries: List[str], k: int = 30) -> List[Tuple[str, float, Dict[str, Any]]]:
+    """BM25 top-k for every query, concatenated; one reader/searcher for the whole batch."""
+    ix = _whoosh_index()
     qp = MultifieldParser(["title", "text"], schema=ix.schema)
-    q = qp.parse(query)
     out = []
     with ix.searcher() as s:
-        res = s.search(q, limit=k)
-        for r in res:
-            out.append((r["chunk_id"], float(r.score), {"doc_id": r["doc_id"], "title": r["title"], "text": r["text"]}))
+        for query in queries:
+            res = s.search(qp.parse(query), limit=k)
+            for r in res:
+                out.append((r["chunk_id"], float(r.score), {"doc_id": r["doc_id"], "title": r["title"], "text": r["text"]}))
     return out
 
-def semantic_topk(query: str, model: SentenceTransformer, client: QdrantClient, k: int = 30):
-    qv = model.encode([query], normalize_embeddings=True)[0]
-    hits = client.search(
+def bm25_topk(query: str, k: int = 30) -> List[Tuple[str, float, Dict[str, Any]]]:
+    return bm25_topk_batch([query], k=k)
+
+def _encode_queries(queries: List[str], model: SentenceTransformer) -> np.ndarray:
+    return np.asarray(model.encode(queries, batch_size=max(1, len(queries)), normalize_embeddings=True),
+                      dtype=np.float32)
+
+def semantic_topk_batch(queries: List[str], model: SentenceTransformer, client: QdrantClient, k: int = 30):
+    """One encode() over all queries and one Qdrant query_batch_points round trip; results concatenated."""
+    return _semantic_topk_vectors(_encode_queries(queries, model), client, k=k)
+
+def _semantic_topk_vectors(qvs: np.ndarray, client: QdrantClient, k: int = 30):
+    batches = client.query_batch_points(
         collection_name=QDRANT_COLLECTION,
-        query_vector=qv.tolist(),
-        limit=k,
-        with_payload=True
+        requests=[models.QueryRequest(query=qv.tolist(), limit=k, with_payload=True) for qv in qvs],
     )
     out = []
-    for h in hits:
-        payload = dict(h.payload)
-        cid = payload.get("chunk_id") or f"{payload.get('doc_id','')}#{payload.get('start_char','?')}"
-        out.append((cid, float(h.score), payload))
+    for res in batches:
+        for h in res.points:
+            payload = dict(h.payload)
+            cid = payload.get("chunk_id") or f"{payload.get('doc_id','')}#{payload.get('start_char','?')}"
+            out.append((cid, float(h.score), payload))
     return out
 
-def _pool_candidates(bm25_list, sem_list) -> Dict[str, Dict[str, Any]]:
-    pooled: Dict[str, Dict[str, Any]] = {}
-    for cid, score, payload in bm25_list:
-        pooled.setdefault(cid, {"payload": payload, "bm25": -1.0, "sem": -1.0})
-        pooled[cid]["bm25"] = max(pooled[cid]["bm25"], float(score))
-    for cid, score, payload in sem_list:
-        pooled.setdefault(cid, {"payload": payload, "bm25": -1.0, "sem": -1.0})
-        pooled[cid]["sem"] = max(pooled[cid]["sem"], float(score))
-        if payload and len(payload.get("text","")) > len(pooled[cid]["payload"].get("text","")):
-            pooled[cid]["payload"] = payload
-    return pooled
-
-def _ensure_text_payload(pooled: Dict[str, Dict[str, Any]]):
-    to_drop = []
-    for cid, item in pooled.items():
-        if not item["payload"].get("text"):
-            to_drop.append(cid)
-    for cid in to_drop:
-        pooled.pop(cid, None)
+def semantic_topk(query: str, model: SentenceTransformer, client: QdrantClient, k: int = 30):
+    return semantic_topk_batch([query], model, client, k=k)
+
+def _best_scores(hits, pos: Dict[str, int], n: int) -> np.ndarray:
+    """Max score per candidate in one scatter-max; -1 where the retriever did not return it."""
+    out = np.full(n, -1.0)
+    if hits:
+        idx = np.fromiter((pos[cid] for cid, _, _ in hits), dtype=np.intp, count=len(hits))
+        np.maximum.at(out, idx, np.fromiter((score for _, score, _ in hits), dtype=np.float64, count=len(hits)))
+    return out
+
+def _pool_candidates(bm25_list, sem_list) -> Tuple[List[str], List[Dict[str, Any]], np.ndarray, np.ndarray]:
+    """
+    Unique chunk ids (first-seen order) with their payload and best BM25 / semantic
+    score. A semantic payload replaces the BM25 one when its text is longer.
+    """
+    payloads: Dict[str, Dict[str, Any]] = {}
+    for cid, _, payload in bm25_list:
+        payloads.setdefault(cid, payload)
+    for cid, _, payload in sem_list:
+        cur = payloads.setdefault(cid, payload)
+        if payload and len(payload.get("text","")) > len(cur.get("text","")):
+            payloads[cid] = payload
+    cids = list(payloads)
+    pos = {cid: i for i, cid in enumerate(cids)}
+    return (cids, [payloads[cid] for cid in cids],
+            _best_scores(bm25_list, pos, len(cids)), _best_scores(sem_list, pos, len(cids)))
 
 def hybrid_search(
     queries: List[str],
@@ -83,47 +155,62 @@ def hybrid_search(
     """
     Returns a list of up to k_final payload dicts (diverse, high-quality).
     """
-    client = QdrantClient(host=QDRANT_HOST, port=QDRANT_PORT)
-    model = SentenceTransformer(EMB_MODEL)
-
-    bm25_all, sem_all = [], []
-    for q in queries:
-        if not q or not q.strip():
-            continue
-        bm25_all.extend(bm25_topk(q, k=topn_bm25))
-        sem_all.extend(semantic_topk(q, model, client, k=topm_sem))
-
-    pooled = _pool_candidates(bm25_all, sem_all)
-    _ensure_text_payload(pooled)
-    if not pooled:
+    model = get_embedder()
+    qs = dedupe_queries(queries)
+    if not qs:
         return []
+    # paraphrased queries ("BFS" / "breadth first search") would retrieve the same chunks
+    qvs = _encode_queries(qs, model)
+    keep = _distinct_rows(qvs, QUERY_DEDUP_COS)
+    qs, qvs = [qs[i] for i in keep], qvs[keep]
+    bm25_all = bm25_topk_batch(qs, k=topn_bm25)
+    sem_all = _semantic_topk_vectors(qvs, get_qdrant(), k=topm_sem)
+
+    _, payloads, bm25, sem = _pool_candidates(bm25_all, sem_all)
+    # drop candidates without text
+    keep = np.fromiter((bool(p.get("text")) for p in payloads), dtype=bool, count=len(payloads))
+    payloads = [p for p, k in zip(payloads, keep) if k]
+    if not payloads:
+        return []
+    bm25, sem = np.maximum(bm25[keep], 0.0), np.maximum(sem[keep], 0.0)
+    rel = (0.5 * _normalize_scores(bm25) + 0.5 * _normalize_scores(sem)).astype(np.float32)
 
-    bm25_scores = [pooled[cid]["bm25"] if pooled[cid]["bm25"] >= 0 else 0.0 for cid in pooled]
-    sem_scores  = [pooled[cid]["sem"]  if pooled[cid]["sem"]  >= 0 else 0.0 for cid in pooled]
-    bm25_norm = _normalize_scores(bm25_scores)
-    sem_norm  = _normalize_scores(sem_scores)
-
-    cids = list(pooled.keys())
-    rel = np.array([0.5*bm25_norm[i] + 0.5*sem_norm[i] for i in range(len(cids))], dtype=np.float32)
-
-    texts = [pooled[cid]["payload"]["text"] for cid in cids]
+    texts = [p["text"] for p in payloads]
     emb = model.encode(texts, batch_size=64, show_progress_bar=False, normalize_embeddings=True)
     emb = np.asarray(emb, dtype=np.float32)
 
-    sel_idx = mmr_select(embeddings=emb, relevance=rel, k=k_mmr, lambda_=lambda_mmr)
-    selected = [cids[i] for i in sel_idx]
+    selected = mmr_select(embeddings=emb, relevance=rel, k=k_mmr, lambda_=lambda_mmr)
 
     if use_cross_encoder:
         try:
-            from sentence_transformers import CrossEncoder
-            ce = CrossEncoder(cross_encoder_model)
-            main_q = next((q for q in queries if q and q.strip()), "")
-            pairs = [(main_q, pooled[cid]["payload"]["text"]) for cid in selected]
+            ce = _cross_encoder(cross_encoder_model)
+            main_q = qs[0]
+            pairs = [(main_q, payloads[i]["text"]) for i in selected]
             scores = ce.predict(pairs)
             ord_idx = list(np.argsort(scores))[::-1]
             selected = [selected[i] for i in ord_idx]
         except Exception:
             pass
 
-    out_payloads = [pooled[cid]["payload"] for cid in selected[:k_final]]
-    return out_payloads
+    return [payloads[i] for i in selected[:k_final]]
+
+@lru_cache(maxsize=512)
+def _cached_search(queries: Tuple[str, ...], k_final: int, k_mmr: int, lambda_mmr: float,
+                   ttl_bucket: int) -> Tuple[Dict[str, Any], ...]:
+    return tuple(hybrid_search(queries=list(queries), k_mmr=k_mmr, lambda_mmr=lambda_mmr, k_final=k_final))
+
+def cached_hybrid_search(
+    queries: List[str],
+    k_final: int = 10,
+    k_mmr: int = 20,
+    lambda_mmr: float = 0.6,
+) -> List[Dict[str, Any]]:
+    """
+    hybrid_search memoized on the de-duplicated (case-insensitive), order-insensitive query set.
+    Entries expire after SEARCH_CACHE_TTL_S (the time bucket is part of the key).
+    Returned payload dicts are shared between callers; treat them as read-only.
+    """
+    # both retrievers are case-insensitive (uncased MiniLM, lowercasing Whoosh analyzer)
+    key = tuple(sorted(q.casefold() for q in dedupe_queries(queries)))
+    bucket = int(time.time() // SEARCH_CACHE_TTL_S)
+    return list(_cached_search(key, k_final, k_mmr, lambda_mmr, bucket))
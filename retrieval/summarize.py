@@ -1,4 +1,5 @@
-from typing import List, Dict
+from typing import List, Dict, Tuple
+from functools import lru_cache
 import re
 
 def _sent_split(text: str) -> List[str]:
@@ -23,9 +24,20 @@ def summarize_to_notes(
       - dedupe by token Jaccard,
       - trim to limits.
     """
+    texts = tuple(ch.get("text","") for ch in chunks)
+    return list(_summarize_texts(texts, max_bullets, max_chars_per_bullet, dedupe_threshold))
+
+@lru_cache(maxsize=512)
+def _summarize_texts(
+    texts: Tuple[str, ...],
+    max_bullets: int,
+    max_chars_per_bullet: int,
+    dedupe_threshold: float,
+) -> Tuple[str, ...]:
+    # pure function of the chunk texts → memoized on their content
     candidates = []
-    for ch in chunks:
-        text = ch.get("text","").strip()
+    for text in texts:
+        text = text.strip()
         if not text:
             continue
         sents = _sent_split(text)
@@ -57,4 +69,4 @@ def summarize_to_notes(
 
     if not bullets:
         bullets = ["• Key facts not found in local corpus."]
-    return bullets
+    return tuple(bullets)
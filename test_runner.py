@@ -2,26 +2,61 @@
 
 import argparse
 import sys
-import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Any, Dict, List
+import orjson
 try:
     import requests
+    from requests.adapters import HTTPAdapter
 except ImportError:
     print("Please install requests: pip install requests", file=sys.stderr)
     sys.exit(1)
 
+# one keep-alive pool for every test call
+SESSION = requests.Session()
+SESSION.headers.update({"Content-Type": "application/json"})
+_ADAPTER = HTTPAdapter(pool_connections=8, pool_maxsize=8)
+SESSION.mount("http://", _ADAPTER)
+SESSION.mount("https://", _ADAPTER)
+
 def pretty(obj):
-    return json.dumps(obj, indent=2, ensure_ascii=False)
+    return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+
+_PRINT_LOCK = threading.Lock()
+
+def say(*args, **kwargs):
+    # tests run concurrently; keep each line whole
+    with _PRINT_LOCK:
+        print(*args, **kwargs, flush=True)
 
 def assert_true(cond, msg):
     if not cond:
         raise AssertionError(msg)
 
 def post(url, payload):
-    r = requests.post(url, headers={"Content-Type":"application/json"}, data=json.dumps(payload), timeout=120)
+    r = SESSION.post(url, data=orjson.dumps(payload), timeout=120)
     if r.status_code != 200:
         raise RuntimeError(f"HTTP {r.status_code}: {r.text}")
-    return r.json()
+    return orjson.loads(r.content)
+
+def post_sse(url, payload):
+    """POST and return the Server-Sent Events as [(event, data), ...] in arrival order."""
+    events, event, data = [], "message", []
+    with SESSION.post(url, data=orjson.dumps(payload), stream=True, timeout=300,
+                      headers={"Accept": "text/event-stream"}) as r:
+        if r.status_code != 200:
+            raise RuntimeError(f"HTTP {r.status_code}: {r.text}")
+        r.encoding = "utf-8"   # SSE is always UTF-8
+        for line in r.iter_lines(decode_unicode=True):
+            if line.startswith("event:"):
+                event = line[6:].strip()
+            elif line.startswith("data:"):
+                data.append(line[5:].lstrip())
+            elif not line and data:
+                events.append((event, orjson.loads("\n".join(data))))
+                event, data = "message", []
+    return events
 
 def count_segments(segments: List[Dict[str, Any]]):
     mermaids = sum(1 for s in segments if isinstance(s.get("mermaid"), str) and s["mermaid"].strip())
@@ -41,16 +76,16 @@ def has_markdown_headings(segments: List[Dict[str, Any]]):
     return False
 
 def test_min_defaults(base):
-    print("TEST: defaults → expect ≥2 diagrams + ≥2 images (JSON only) ...", end="", flush=True)
+    label = "TEST: defaults → expect ≥2 diagrams + ≥2 images (JSON only) ..."
     j = post(f"{base}/lesson", {"chat":"teach me routing protocols"})
     m,i = count_segments(j["segments"])
     assert_true(m >= 2, f"expected >=2 mermaid, got {m}")
     assert_true(i >= 2, f"expected >=2 image_prompts, got {i}")
     assert_true(has_markdown_headings(j["segments"]), "expected markdown-rich text")
-    print(" OK")
+    say(label, "OK")
 
 def test_min_defaults_rendered(base):
-    print("TEST: defaults rendered → expect ≥2 diagram PNGs + ≥2 image PNGs ...", end="", flush=True)
+    label = "TEST: defaults rendered → expect ≥2 diagram PNGs + ≥2 image PNGs ..."
     j = post(f"{base}/lesson_rendered", {"chat":"teach me routing protocols"})
     dp, ip = count_rendered(j["segments"])
     assert_true(dp >= 2, f"expected >=2 diagram PNGs, got {dp}")
@@ -61,23 +96,42 @@ def test_min_defaults_rendered(base):
             assert_true(bool(s.get("diagram_url")), "diagram_url missing")
         if s.get("image_path"):
             assert_true(bool(s.get("image_url")), "image_url missing")
-    print(" OK")
+    say(label, "OK")
+
+def test_stream_rendered(base):
+    label = "TEST: streamed rendered → lesson first, assets as they finish, done last ..."
+    events = post_sse(f"{base}/lesson_rendered_stream", {"chat":"teach me routing protocols"})
+    kinds = [e for e, _ in events]
+    assert_true(kinds and kinds[0] == "lesson", f"expected 'lesson' first, got {kinds[:1]}")
+    assert_true(kinds[-1] == "done", f"expected 'done' last, got {kinds[-1:]} (errors: {[d for e, d in events if e == 'error']})")
+    assert_true(set(kinds[1:-1]) <= {"diagram", "image"}, f"unexpected events: {kinds}")
+    draft, done = events[0][1], events[-1][1]
+    n = len(draft["segments"])
+    assert_true(len(done["segments"]) == n, "done changed the segment count")
+    for e, d in events[1:-1]:
+        assert_true(0 <= d["idx"] < n, f"{e} event idx {d['idx']} out of range")
+        if d.get(f"{e}_path"):
+            assert_true(done["segments"][d["idx"]].get(f"{e}_path") == d[f"{e}_path"], f"{e} {d['idx']} differs in done")
+    dp, ip = count_rendered(done["segments"])
+    assert_true(dp >= 2, f"expected >=2 diagram PNGs, got {dp}")
+    assert_true(ip >= 2, f"expected >=2 image PNGs, got {ip}")
+    say(label, "OK")
 
 def test_custom_counts(base):
-    print("TEST: custom counts → 3 diagrams + 4 images (JSON only) ...", end="", flush=True)
+    label = "TEST: custom counts → 3 diagrams + 4 images (JSON only) ..."
     j = post(f"{base}/lesson", {"chat":"teach BFS with 3 diagrams and 4 images"})
     m,i = count_segments(j["segments"])
     assert_true(m >= 3, f"expected >=3 mermaid, got {m}")
     assert_true(i >= 4, f"expected >=4 image_prompts, got {i}")
-    print(" OK")
+    say(label, "OK")
 
 def test_custom_counts_rendered(base):
-    print("TEST: custom counts rendered → 3 diagram PNGs + 4 image PNGs ...", end="", flush=True)
+    label = "TEST: custom counts rendered → 3 diagram PNGs + 4 image PNGs ..."
     j = post(f"{base}/lesson_rendered", {"chat":"teach BFS with 3 diagrams and 4 images"})
     dp, ip = count_rendered(j["segments"])
     assert_true(dp >= 3, f"expected >=3 diagram PNGs, got {dp}")
     assert_true(ip >= 4, f"expected >=4 image PNGs, got {ip}")
-    print(" OK")
+    say(label, "OK")
 
 def main():
     import argparse
@@ -85,15 +139,22 @@ def main():
     ap.add_argument("--base", default="http://localhost:8000", help="API base URL")
     args = ap.parse_args()
 
-    try:
-        test_min_defaults(args.base)
-        test_min_defaults_rendered(args.base)
-        test_custom_counts(args.base)
-        test_custom_counts_rendered(args.base)
-        print("\nAll tests passed ✅")
-    except Exception as e:
-        print("\nFAILED ❌:", e, file=sys.stderr)
+    tests = [test_min_defaults, test_min_defaults_rendered, test_stream_rendered,
+             test_custom_counts, test_custom_counts_rendered]
+    failed = 0
+    # independent tests: total time is the slowest one, not the sum
+    with ThreadPoolExecutor(max_workers=len(tests)) as ex:
+        futures = {ex.submit(t, args.base): t.__name__ for t in tests}
+        for fut in as_completed(futures):
+            try:
+                fut.result()
+            except Exception as e:
+                failed += 1
+                say(f"FAILED ❌ {futures[fut]}:", e, file=sys.stderr)
+    if failed:
+        say(f"\n{failed}/{len(tests)} tests failed ❌", file=sys.stderr)
         sys.exit(2)
+    say("\nAll tests passed ✅")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,32 @@
+import numpy as np
+
+from retrieval.hybrid_search import _distinct_rows, dedupe_queries
+
+
+def test_dedupe_queries_case_and_whitespace():
+    assert dedupe_queries(["BFS", " bfs ", "Breadth  First\tSearch", "breadth first search", "queue"]) == \
+        ["BFS", "Breadth First Search", "queue"]
+
+
+def test_dedupe_queries_drops_empty():
+    assert dedupe_queries(["", "   ", None, "graph"]) == ["graph"]
+
+
+def test_dedupe_queries_casefold():
+    assert dedupe_queries(["STRASSE", "straße"]) == ["STRASSE"]
+
+
+def _unit(rows):
+    v = np.asarray(rows, dtype=np.float32)
+    return v / np.linalg.norm(v, axis=1, keepdims=True)
+
+
+def test_distinct_rows_drops_near_duplicates():
+    vecs = _unit([[1, 0, 0], [0.999, 0.04, 0], [0, 1, 0], [0.7, 0.7, 0]])
+    assert _distinct_rows(vecs, 0.95) == [0, 2, 3]
+
+
+def test_distinct_rows_keeps_all_when_threshold_is_high():
+    vecs = _unit([[1, 0], [1, 0], [0, 1]])
+    assert _distinct_rows(vecs, 1.01) == [0, 1, 2]
+    assert _distinct_rows(vecs[:0], 0.95) == []
@@ -0,0 +1,63 @@
+import orjson
+import pytest
+
+from api import llm_gateway
+from api.llm_gateway import _balanced_prefix, _extract_json, _json_complete
+
+
+def test_balanced_prefix_stops_at_closing_brace():
+    assert _balanced_prefix('{"a": {"b": 1}} trailing {x}') == '{"a": {"b": 1}}'
+
+
+@pytest.mark.parametrize("obj", [
+    '{"a": "}"}',
+    '{"a": "{{{"}',
+    '{"a": "} {", "b": {"c": "}}"}}',
+])
+def test_braces_inside_strings_are_ignored(obj):
+    assert _balanced_prefix(obj + " tail }") == obj
+
+
+@pytest.mark.parametrize("obj", [
+    r'{"a": "say \"}\" twice"}',      # \" is an escaped quote: the string goes on
+    r'{"a": "dir\\"}',                 # \\" is an escaped backslash, then a real closing quote
+    r'{"a": "x\\\"}\\"}',             # \\\" escaped backslash + escaped quote, \\" closes
+])
+def test_backslash_escapes(obj):
+    assert _balanced_prefix(obj + " }") == obj
+    assert orjson.loads(obj)
+
+
+def test_non_ascii_text():
+    obj = '{"t": "Größe → 图 {不} ✓", "e": "🙂"}'
+    assert _balanced_prefix(obj + "\nnach}") == obj
+
+
+@pytest.mark.parametrize("text", ["", "{", '{"a": {"b": 1}', '{"a": "}', "no braces"])
+def test_unclosed_input(text):
+    assert _balanced_prefix(text) is None
+
+
+def test_scan_cap(monkeypatch):
+    big = '{"a": "' + "x" * llm_gateway._MAX_JSON_SCAN + '"}'
+    assert _balanced_prefix(big) is None
+    monkeypatch.setattr(llm_gateway, "_MAX_JSON_SCAN", len(big))
+    assert _balanced_prefix(big) == big
+
+
+def test_extract_json_from_prose_and_fences():
+    assert _extract_json('Sure! {"topic": "BFS {graphs}"} Hope that helps.') == {"topic": "BFS {graphs}"}
+    assert _extract_json('```json\n{"a": 1}\n```') == {"a": 1}
+    assert _extract_json("no json here") == {"raw": "no json here"}
+
+
+def test_extract_json_fence_cut_off_mid_stream():
+    # the stream is hung up as soon as the object closes, so the closing fence never arrives
+    assert _extract_json('```json\n{"a": "}", "b": [1, 2]}') == {"a": "}", "b": [1, 2]}
+
+
+def test_json_complete_on_partial_streams():
+    assert not _json_complete('```json\n{"a": "}')
+    assert not _json_complete('```json\n{"a": {"b": 1}')
+    assert _json_complete('```json\n{"a": {"b": "}"}}')
+    assert not _json_complete("```json\n{not json}")
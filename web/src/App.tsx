@@ -1,5 +1,5 @@
 import { useState } from "react";
-import { fetchLesson } from "./api";
+import { fetchLesson, streamLesson } from "./api";
 import { LessonWithAssets, LessonDraft, LessonSegment } from "./types";
 import SegmentCard from "./components/SegmentCard";
 
@@ -9,6 +9,7 @@ export default function App() {
   const [chat, setChat] = useState("teach me routing protocols");
   const [useRendered, setUseRendered] = useState(true);
   const [loading, setLoading] = useState(false);
+  const [rendering, setRendering] = useState(false);
   const [data, setData] = useState<Data | null>(null);
   const [error, setError] = useState<string | null>(null);
 
@@ -18,12 +19,26 @@ export default function App() {
     setLoading(true);
     setData(null);
     try {
-      const res = await fetchLesson(chat, useRendered);
-      setData(res as Data);
+      if (useRendered) {
+        // text shows up as soon as the draft is ready; assets fill in as they finish
+        await streamLesson(chat, {
+          onLesson: (draft) => { setData(draft); setRendering(true); },
+          onAsset: (_kind, { idx, ...asset }) =>
+            setData((prev) => prev && {
+              ...prev,
+              segments: prev.segments.map((s, i) => (i === idx ? { ...s, ...asset } : s)),
+            }),
+          onDone: (lesson) => setData(lesson),
+        });
+      } else {
+        const res = await fetchLesson(chat, false);
+        setData(res as Data);
+      }
     } catch (err: any) {
       setError(err?.message || "Request failed");
     } finally {
       setLoading(false);
+      setRendering(false);
     }
   }
 
@@ -55,7 +70,7 @@ export default function App() {
             placeholder="Ask: teach BFS with 3 diagrams and 4 images"
           />
           <button className="button" type="submit" disabled={loading}>
-            {loading ? "Generating..." : "Generate"}
+            {rendering ? "Rendering assets..." : loading ? "Generating..." : "Generate"}
           </button>
           <label className="switch">
             <input
@@ -63,7 +78,7 @@ export default function App() {
               checked={useRendered}
               onChange={(e) => setUseRendered(e.target.checked)}
             />
-            Use /lesson_rendered
+            Use /lesson_rendered_stream
           </label>
         </form>
         {error && (
@@ -1,3 +1,5 @@
+import { LessonStreamHandlers } from "./types";
+
 const API_BASE = import.meta.env.VITE_API_BASE ?? "http://localhost:8000";
 
 export async function postJSON<T>(path: string, payload: unknown): Promise<T> {
@@ -17,3 +19,49 @@ export async function fetchLesson(chat: string, rendered = true) {
   const endpoint = rendered ? "/lesson_rendered" : "/lesson";
   return postJSON(endpoint, { chat });
 }
+
+// EventSource can only GET, so the stream is read from a POST fetch and parsed by hand.
+function dispatchSSE(block: string, handlers: LessonStreamHandlers) {
+  let event = "message";
+  const data: string[] = [];
+  for (const line of block.split("\n")) {
+    if (line.startsWith("event:")) event = line.slice(6).trim();
+    else if (line.startsWith("data:")) data.push(line.slice(5).trimStart());
+  }
+  if (!data.length) return;
+  const payload = JSON.parse(data.join("\n"));
+  if (event === "lesson") handlers.onLesson(payload);
+  else if (event === "diagram" || event === "image") handlers.onAsset(event, payload);
+  else if (event === "done") handlers.onDone(payload);
+  else if (event === "error") throw new Error(payload.detail || "stream failed");
+}
+
+export async function streamLesson(chat: string, handlers: LessonStreamHandlers): Promise<void> {
+  const res = await fetch(`${API_BASE}/lesson_rendered_stream`, {
+    method: "POST",
+    headers: {"Content-Type": "application/json", Accept: "text/event-stream"},
+    body: JSON.stringify({ chat })
+  });
+  if (!res.ok || !res.body) {
+    const text = await res.text();
+    throw new Error(`HTTP ${res.status}: ${text}`);
+  }
+  const reader = res.body.pipeThrough(new TextDecoderStream()).getReader();
+  let buf = "";
+  try {
+    for (;;) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buf = (buf + value).replace(/\r\n/g, "\n");
+      let cut: number;
+      while ((cut = buf.indexOf("\n\n")) !== -1) {
+        dispatchSSE(buf.slice(0, cut), handlers);
+        buf = buf.slice(cut + 2);
+      }
+    }
+    if (buf.trim()) dispatchSSE(buf, handlers);
+  } catch (err) {
+    await reader.cancel().catch(() => {});
+    throw err;
+  }
+}
@@ -25,3 +25,19 @@ export interface LessonDraft {
 export interface LessonWithAssets extends LessonDraft {
   artifacts_root?: string | null;
 }
+
+// /lesson_rendered_stream events (Server-Sent Events over a POST response)
+export interface AssetEvent {
+  idx: number;
+  mermaid?: string | null;
+  diagram_path?: string | null;
+  diagram_url?: string | null;
+  image_path?: string | null;
+  image_url?: string | null;
+}
+
+export interface LessonStreamHandlers {
+  onLesson: (draft: LessonWithAssets) => void;
+  onAsset: (kind: "diagram" | "image", asset: AssetEvent) => void;
+  onDone: (lesson: LessonWithAssets) => void;
+}